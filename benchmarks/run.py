@@ -0,0 +1,117 @@
+"""
+Benchmarks MirrorLDAPGroup against an in-process fake directory and an SQLite database, no network is needed
+
+Run from the repository root:
+python -m benchmarks.run --sizes 100,1000,10000,100000 --domains 3 --latency 0.002 --option ldap_pipeline=True
+
+Each group size is mirrored three times:
+cold  - into an empty database
+warm  - again with nothing changed
+churn - after 1% of the members were removed, 1% added and 1% renamed
+"""
+import argparse
+import ast
+import json
+import os
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+from django.contrib.auth.models import User, Group
+from django.core.management import call_command
+from django_mirror_ldap_group.mirror_ldap_group import MirrorLDAPGroup
+from django_mirror_ldap_group.models import LDAPGroupSyncState
+from django_mirror_ldap_group.testing import FakeDirectory, patch_initialize
+
+
+COLUMNS = ['members', 'scenario', 'wall_seconds', 'round_trips', 'binds', 'searches', 'db_queries',
+           'users_created', 'users_updated', 'users_added', 'users_removed']
+
+
+def parse_option(value):
+    """
+    :param value: A MirrorLDAPGroup init parameter as name=value, the value is a Python literal. Example: ldap_max_workers=4
+    :return: A tuple of the name and value
+    """
+    name, _, literal = value.partition('=')
+    try:
+        return name, ast.literal_eval(literal)
+    except (SyntaxError, ValueError):
+        raise argparse.ArgumentTypeError(u"Options must be name=python literal, got {0}".format(value))
+
+
+def churn(directory, group_dn, fraction=0.01):
+    """
+    Removes, adds and renames a fraction of the members of the group
+    """
+    member_dns = list(directory.entry(group_dn)['member'])
+    changes = max(1, int(len(member_dns) * fraction))
+    next_index = len(member_dns) + 1000000  # New users never collide with existing ones
+    member_dns = member_dns[changes:] + [directory.add_user(next_index + index) for index in range(changes)]
+    for member_dn in member_dns[:changes]:
+        directory.update(member_dn, mail=['renamed.' + directory.entry(member_dn)['mail'][0]])
+    directory.update(group_dn, member=member_dns)
+
+
+def mirror(directory, members, scenario, options):
+    """
+    :return: A dictionary of the COLUMNS for one mirror run
+    """
+    servers = directory.servers()
+    mirror_ldap_group = MirrorLDAPGroup(ldap_group_base_dn='OU=Groups,{0}'.format(directory.naming_contexts[0]),
+                                        ldap_uri=servers[0]['uri'],
+                                        ldap_username=servers[0]['username'],
+                                        ldap_password=servers[0]['password'],
+                                        ldap_group_name='Bench',
+                                        ldap_referrals=servers[1:],
+                                        **options)
+    directory.reset_counters()
+    started = time.time()
+    status, message = mirror_ldap_group.mirror_ldap_group()
+    wall_seconds = time.time() - started
+    if not status:
+        raise SystemExit(message)
+
+    row = dict((column, mirror_ldap_group.report.counters.get(column, 0)) for column in COLUMNS)
+    row.update(directory.counters)
+    row.update(members=members, scenario=scenario, wall_seconds=round(wall_seconds, 3))
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help='Comma separated group sizes. Default: 100,1000,10000')
+    parser.add_argument('--domains', default=3, type=int, help='Number of domains the members are spread across')
+    parser.add_argument('--latency', default=0.0, type=float, help='Seconds each LDAP round trip takes')
+    parser.add_argument('--option', action='append', default=[], type=parse_option, dest='options',
+                        help='A MirrorLDAPGroup init parameter as name=value, can be repeated')
+    parser.add_argument('--json', action='store_true', help='Print one JSON object per run instead of a table')
+    arguments = parser.parse_args()
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    options = dict(arguments.options)
+
+    if not arguments.json:
+        print u' '.join(u'{0:>13}'.format(column) for column in COLUMNS)
+    for members in arguments.sizes:
+        User.objects.all().delete()
+        Group.objects.all().delete()
+        LDAPGroupSyncState.objects.all().delete()
+        directory = FakeDirectory.synthetic(members, domains=arguments.domains, latency=arguments.latency)
+        group_dn = 'CN=Bench,OU=Groups,{0}'.format(directory.naming_contexts[0])
+
+        with patch_initialize(directory):
+            for scenario in ('cold', 'warm', 'churn'):
+                if scenario == 'churn':
+                    churn(directory, group_dn)
+                row = mirror(directory, members, scenario, options)
+                if arguments.json:
+                    print json.dumps(row, sort_keys=True)
+                else:
+                    print u' '.join(u'{0:>13}'.format(row[column]) for column in COLUMNS)
+
+
+if __name__ == '__main__':
+    main()
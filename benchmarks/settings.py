@@ -0,0 +1,17 @@
+import os
+
+# Django settings of the benchmark project, set BENCHMARK_DATABASE to a file path to keep the database
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('BENCHMARK_DATABASE', ':memory:'),
+    }
+}
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django_mirror_ldap_group',
+)
+SECRET_KEY = 'benchmark'
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+USE_TZ = True
@@ -1,15 +1,411 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 import ldap
+import ldap.dn
+import ldap.filter
+from ldap.controls import SimplePagedResultsControl
+
+
+# Only the attributes needed to mirror a user are requested from Active Directory
+USER_ATTRIBUTES = ['sAMAccountName', 'givenName', 'sn', 'mail']
+
+
+def _timed(phase):
+    """
+    :param phase: The name of a MirrorReport phase
+    :return: A decorator adding the time spent in an LDAPAPI method to the phase of its report
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self._phase(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class LDAPLookupError(Exception):
+    """
+    Raised by the LDAPAPI generators when a lookup fails, the message is the same error message
+    the status returning methods give back
+    """
+    pass
+
+
+class LDAPConnectionPool(object):
+    """
+    Keeps bound LDAP connections for each URI and bind account so lookups can reuse them
+
+    Connections are checked out with the 'connection' context manager and returned to the pool afterwards
+    Idle connections are health checked with a whoami before being handed out again and are rebound if the
+    server has dropped them
+    Each checked out connection is used by one thread at a time, max_connections_per_uri caps how many can be
+    checked out for a URI at once, further checkouts wait until one is returned
+    New binds are counted in the report passed to 'connection', see report.MirrorReport
+    """
+    def __init__(self, max_idle_per_uri=4, health_check_interval=60, max_connections_per_uri=None):
+        """
+        :param max_idle_per_uri: The maximum number of idle bound connections to keep for each URI.
+        :param health_check_interval: Seconds a connection can sit idle before it is health checked on checkout.
+        :param max_connections_per_uri: Optional. The maximum number of connections in use at once for each URI.
+        :return: Nothing
+        """
+        self.max_idle_per_uri = max_idle_per_uri
+        self.health_check_interval = health_check_interval
+        self.max_connections_per_uri = max_connections_per_uri
+        self._idle_connections = {}  # (uri, username) = List of (connection, last used time)
+        self._uri_semaphores = {}  # uri = Semaphore limiting the connections in use
+        self._lock = threading.Lock()
+        self._local = threading.local()  # reused = True if the last checkout on the thread was an idle connection
+
+    @contextmanager
+    def connection(self, ldap_uri, ldap_username, ldap_password, report=None):
+        """
+        :param ldap_uri: The uri to the AD Domain
+        :param ldap_username: The username of the bind account
+        :param ldap_password: The password of the bind account
+        :param report: Optional. A MirrorReport to count a new bind in
+        :return: A bound ldap connection object that is returned to the pool on exit
+
+        Connections that raise ldap.SERVER_DOWN are discarded instead of being returned to the pool, together with the
+        idle connections to the same URI and bind account since they were most likely dropped as well
+        """
+        uri_semaphore = self._uri_semaphore(ldap_uri)
+        if uri_semaphore:
+            uri_semaphore.acquire()
+        try:
+            self._local.reused = False
+            ldap_connection, self._local.reused = self._checkout(ldap_uri, ldap_username, ldap_password, report)
+            try:
+                yield ldap_connection
+            except ldap.SERVER_DOWN:
+                self._discard(ldap_connection)
+                self.discard_idle(ldap_uri, ldap_username)
+                raise
+            except:
+                self._checkin(ldap_uri, ldap_username, ldap_connection)
+                raise
+            else:
+                self._checkin(ldap_uri, ldap_username, ldap_connection)
+        finally:
+            if uri_semaphore:
+                uri_semaphore.release()
+
+    def reused(self):
+        """
+        :return: True if the last connection checked out on this thread was an idle pooled connection, False if it
+                 was newly bound or could not be bound
+        """
+        return getattr(self._local, 'reused', False)
+
+    def close(self):
+        """
+        Unbinds every idle connection in the pool
+        """
+        with self._lock:
+            idle_connections = self._idle_connections
+            self._idle_connections = {}
+        for connections in idle_connections.values():
+            for ldap_connection, last_used in connections:
+                self._discard(ldap_connection)
+
+    def discard_idle(self, ldap_uri, ldap_username):
+        """
+        Unbinds the idle connections to a URI with a bind account, the next checkout binds a fresh connection
+        """
+        with self._lock:
+            connections = self._idle_connections.pop((ldap_uri, ldap_username), [])
+        for ldap_connection, last_used in connections:
+            self._discard(ldap_connection)
+
+    def _uri_semaphore(self, ldap_uri):
+        if not self.max_connections_per_uri:
+            return None
+        with self._lock:
+            return self._uri_semaphores.setdefault(ldap_uri, threading.BoundedSemaphore(self.max_connections_per_uri))
+
+    def _checkout(self, ldap_uri, ldap_username, ldap_password, report=None):
+        while True:
+            with self._lock:
+                connections = self._idle_connections.get((ldap_uri, ldap_username))
+                if not connections:
+                    break
+                ldap_connection, last_used = connections.pop()
+            if time.time() - last_used < self.health_check_interval or self._is_healthy(ldap_connection):
+                return ldap_connection, True
+            self._discard(ldap_connection)
+
+        started = time.time()
+        ldap_connection = LDAPAPI._connect(ldap_uri, ldap_username, ldap_password)
+        if report is not None:
+            report.incr('ldap_binds')
+            report.add_time('ldap_bind', time.time() - started)
+        return ldap_connection, False
+
+    def _checkin(self, ldap_uri, ldap_username, ldap_connection):
+        with self._lock:
+            connections = self._idle_connections.setdefault((ldap_uri, ldap_username), [])
+            if len(connections) < self.max_idle_per_uri:
+                connections.append((ldap_connection, time.time()))
+                return
+        self._discard(ldap_connection)
+
+    @staticmethod
+    def _is_healthy(ldap_connection):
+        try:
+            ldap_connection.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+    @staticmethod
+    def _discard(ldap_connection):
+        try:
+            LDAPAPI._ldap_disconnect(ldap_connection)
+        except ldap.LDAPError:
+            pass
+
+
+class BaseUserCache(object):
+    """
+    Caches the Active Directory attributes of users by DN between lookups and runs
+
+    Subclasses implement _get_many and _set_many, hits and misses are counted here
+    Any object with get_many and set_many methods can be passed to LDAPAPI as the user_cache
+    """
+    def __init__(self, timeout=900):
+        """
+        :param timeout: Seconds a users attributes are kept before they are looked up again.
+        :return: Nothing
+        """
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, userdns):
+        """
+        :param userdns: A list of distinguished names of users
+        :return: A dictionary of user DN to the users Active Directory attributes for the DNs that are cached
+        """
+        users = self._get_many(userdns)
+        self.hits += len(users)
+        self.misses += len(userdns) - len(users)
+        return users
+
+    def set_many(self, users):
+        """
+        :param users: A dictionary of user DN to the users Active Directory attributes
+        """
+        if users:
+            self._set_many(users)
+
+    def _get_many(self, userdns):
+        raise NotImplementedError
+
+    def _set_many(self, users):
+        raise NotImplementedError
+
+
+class LocMemUserCache(BaseUserCache):
+    """
+    In-process user cache with a TTL and an LRU size limit
+    """
+    def __init__(self, timeout=900, max_entries=10000):
+        """
+        :param timeout: Seconds a users attributes are kept before they are looked up again.
+        :param max_entries: The maximum number of users kept, the least recently used users are evicted first.
+        :return: Nothing
+        """
+        super(LocMemUserCache, self).__init__(timeout=timeout)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # userdn = (expiry time, attributes)
+        self._lock = threading.Lock()
+
+    def _get_many(self, userdns):
+        users = {}
+        now = time.time()
+        with self._lock:
+            for userdn in userdns:
+                entry = self._entries.pop(userdn, None)
+                if entry and entry[0] > now:
+                    self._entries[userdn] = entry  # Reinsert as the most recently used
+                    users[userdn] = entry[1]
+        return users
+
+    def _set_many(self, users):
+        expires = time.time() + self.timeout
+        with self._lock:
+            for userdn, user_dictionary in users.items():
+                self._entries.pop(userdn, None)
+                self._entries[userdn] = (expires, user_dictionary)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DjangoUserCache(BaseUserCache):
+    """
+    User cache stored in a Django cache backend so several workers can share it
+    The LRU size limit is the one of the cache backend, for example the MAX_ENTRIES option of CACHES
+    """
+    def __init__(self, timeout=900, cache_alias='default', key_prefix='django_mirror_ldap_group.user'):
+        """
+        :param timeout: Seconds a users attributes are kept before they are looked up again.
+        :param cache_alias: The name of the cache in the CACHES setting to use.
+        :param key_prefix: Prefix of the cache keys, the rest of the key is a hash of the DN.
+        :return: Nothing
+        """
+        from django.core.cache import get_cache
+        super(DjangoUserCache, self).__init__(timeout=timeout)
+        self.cache = get_cache(cache_alias)
+        self.key_prefix = key_prefix
+
+    def _key(self, userdn):
+        # DNs contain characters memcached does not allow in keys
+        return '{0}.{1}'.format(self.key_prefix, hashlib.md5(userdn.lower()).hexdigest())
+
+    def _get_many(self, userdns):
+        userdns_by_key = dict((self._key(userdn), userdn) for userdn in userdns)
+        return dict((userdns_by_key[key], user_dictionary)
+                    for key, user_dictionary in self.cache.get_many(userdns_by_key.keys()).items())
+
+    def _set_many(self, users):
+        self.cache.set_many(dict((self._key(userdn), user_dictionary) for userdn, user_dictionary in users.items()),
+                            self.timeout)
+
+
+class DomainRouter(object):
+    """
+    Routes distinguished names to the server that owns their naming context (the trailing DC= components)
+
+    Owners are declared with a 'naming_context' key in the server dictionaries, discovered from the
+    defaultNamingContext of each servers rootDSE, or learned from the first server that answered a search
+    Servers that returned a referral for a naming context are remembered so they are not asked again
+    Share one router between LDAPAPI instances to keep what was learned between runs, instances with different
+    servers for the same domain each get their own servers, see servers_for
+    """
+    def __init__(self, discover=True):
+        """
+        :param discover: True or False read the defaultNamingContext of servers without a declared naming_context.
+        :return: Nothing
+        """
+        self.discover = discover
+        self._owners = {}  # naming context = Set of server uris that hold it
+        self._misses = {}  # naming context = Set of server uris that returned a referral
+        self._routed_uris = set()  # Server uris whose naming context has been declared or discovered
+        self._lock = threading.Lock()
+
+    def servers_for(self, ldapapi, naming_context):
+        """
+        :param ldapapi: The LDAPAPI instance whose servers are routed to
+        :param naming_context: A naming context. Example: 'DC=mydomain,DC=com'
+        :return: A list of server dictionaries to try in order, only the owners if one of them is a server of ldapapi,
+                 otherwise every server of ldapapi that has not returned a referral for the naming context
+
+        The rootDSE of new servers is read outside the lock so other threads are not held up by the network
+        """
+        ldap_servers = ldapapi._ldap_servers()
+        with self._lock:
+            new_servers = [ldap_server for ldap_server in ldap_servers
+                           if ldap_server.get('uri') not in self._routed_uris]
+            self._routed_uris.update(ldap_server.get('uri') for ldap_server in new_servers)
+
+        owned_naming_contexts = []
+        for ldap_server in new_servers:
+            owned_naming_context = ldap_server.get('naming_context')
+            if not owned_naming_context and self.discover:
+                owned_naming_context = ldapapi.get_default_naming_context(ldap_server)
+            if owned_naming_context:
+                owned_naming_contexts.append((owned_naming_context, ldap_server))
+
+        with self._lock:
+            for owned_naming_context, ldap_server in owned_naming_contexts:
+                self._owners.setdefault(owned_naming_context.lower(), set()).add(ldap_server.get('uri'))
+            owners = set(self._owners.get(naming_context.lower(), ()))
+            misses = set(self._misses.get(naming_context.lower(), ()))
+
+        owner_servers = [ldap_server for ldap_server in ldap_servers if ldap_server.get('uri') in owners]
+        if owner_servers:
+            return owner_servers
+        return [ldap_server for ldap_server in ldap_servers if ldap_server.get('uri') not in misses]
+
+    def answered(self, naming_context, ldap_server):
+        with self._lock:
+            self._owners.setdefault(naming_context.lower(), set()).add(ldap_server.get('uri'))
+
+    def failed(self, naming_context, ldap_server, error):
+        # Only a referral says the server does not hold the naming context, other errors may be transient
+        if isinstance(error, ldap.REFERRAL):
+            with self._lock:
+                self._misses.setdefault(naming_context.lower(), set()).add(ldap_server.get('uri'))
 
 
 # Python LDAP Resources
 # https://blogs.oracle.com/marginNotes/entry/ldap_basics_with_python
 # http://code.activestate.com/lists/python-list/603895/
 class LDAPAPI(object):
-    def __init__(self, ldap_uri, ldap_username, ldap_password, ldap_referrals=()):
+    """
+    Bound connections are kept in a connection pool and reused across lookups
+    Use as a context manager or call close() when done so the pooled connections are unbound
+    Pass a report.MirrorReport as report to time the lookups and count the LDAP requests
+    """
+    def __init__(self, ldap_uri, ldap_username, ldap_password, ldap_referrals=(), connection_pool=None,
+                 chunk_size=100, page_size=1000, user_cache=None, max_workers=1, max_connections_per_uri=None,
+                 domain_router=None, pipeline=False, pipeline_depth=10, nested_groups=False, report=None):
         self.ldap_uri = ldap_uri
         self.ldap_username = ldap_username
         self.ldap_password = ldap_password
         self.ldap_referrals = ldap_referrals
+        self.max_workers = max_workers
+        self.connection_pool = connection_pool or LDAPConnectionPool(max_idle_per_uri=max(4, max_workers),
+                                                                     max_connections_per_uri=max_connections_per_uri)
+        self.chunk_size = chunk_size
+        self.page_size = page_size
+        self.user_cache = user_cache
+        self.domain_router = domain_router or DomainRouter()
+        self.pipeline = pipeline
+        self.pipeline_depth = pipeline_depth
+        self.nested_groups = nested_groups
+        self.report = report
+        # Nested groups are read once for the life of the LDAPAPI, see _iter_nested_member_dns
+        self._member_dns_by_group = {}
+        self._is_group_by_dn = {}
+        # The thread pool of the member lookups is started on first use and kept until close, see _thread_pool
+        self._threads = None
+        self._threads_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Stops the lookup threads and unbinds all pooled connections
+        """
+        with self._threads_lock:
+            threads, self._threads = self._threads, None
+        if threads is not None:
+            threads.close()
+            threads.join()
+        self.connection_pool.close()
+
+    def _thread_pool(self):
+        """
+        :return: The thread pool of max_workers threads shared by every get_users_attributes call
+
+        Starting and joining a pool costs about a tenth of a second on Python 2, so it is made once per LDAPAPI
+        instead of once per page of members
+        """
+        with self._threads_lock:
+            if self._threads is None:
+                self._threads = ThreadPool(self.max_workers)
+            return self._threads
 
     @property
     def ldap_uri(self):
@@ -46,12 +442,134 @@ class LDAPAPI(object):
     def ldap_referrals(self, value):
         if value:
             error_msg = u"LDAP Referrals Must be an list of dictionaries with the keys uri, username, and password! " \
+                        u"The key naming_context is optional. " \
                         u"Example: [{'uri': 'ldap://mydomain.com', " \
                         u"'username': 'CN=MY_ACCOUNT,OU=Accounts,DC=mydomain,DC=com', " \
                         u"'password': 'mypassword'},]"
             if not isinstance(value, (tuple, list)): raise ValueError(error_msg)
         self._ldap_referrals = value
 
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @chunk_size.setter
+    def chunk_size(self, value):
+        if not isinstance(value, int) or value < 1: raise ValueError(u"The chunk size must be a positive integer!")
+        self._chunk_size = value
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    @max_workers.setter
+    def max_workers(self, value):
+        if not isinstance(value, int) or value < 1: raise ValueError(u"The max workers must be a positive integer!")
+        self._max_workers = value
+
+    @property
+    def pipeline_depth(self):
+        return self._pipeline_depth
+
+    @pipeline_depth.setter
+    def pipeline_depth(self, value):
+        if not isinstance(value, int) or value < 1: raise ValueError(u"The pipeline depth must be a positive integer!")
+        self._pipeline_depth = value
+
+    @property
+    def page_size(self):
+        return self._page_size
+
+    @page_size.setter
+    def page_size(self, value):
+        if not isinstance(value, int) or value < 1: raise ValueError(u"The page size must be a positive integer!")
+        self._page_size = value
+
+    def _incr(self, counter, count=1):
+        if self.report is not None:
+            self.report.incr(counter, count)
+
+    @contextmanager
+    def _phase(self, phase):
+        if self.report is None:
+            yield
+        else:
+            with self.report.phase(phase):
+                yield
+
+    def _server_failed(self, naming_context, ldap_server, error):
+        """
+        Tells the domain router a server failed for a naming context, a referral sends the lookup on to the next server
+        """
+        if isinstance(error, ldap.REFERRAL):
+            self._incr('ldap_referral_fallbacks')
+        self.domain_router.failed(naming_context, ldap_server, error)
+
+    def _ldap_servers(self):
+        """
+        :return: A list of connection dictionaries with the keys uri, username and password, primary server first
+        """
+        primary = {'uri': self.ldap_uri, 'username': self.ldap_username, 'password': self.ldap_password}
+        return [primary] + list(self.ldap_referrals or ())
+
+    def get_default_naming_context(self, ldap_server):
+        """
+        :param ldap_server: A connection dictionary with the keys uri, username and password
+        :return: The defaultNamingContext from the rootDSE of the server or None if it could not be read
+        """
+        try:
+            root_dse_result = self._search(ldap_uri=ldap_server.get('uri'),
+                                           ldap_username=ldap_server.get('username'),
+                                           ldap_password=ldap_server.get('password'),
+                                           base='',
+                                           scope=ldap.SCOPE_BASE,
+                                           attrlist=['defaultNamingContext'])
+            return root_dse_result[0][1]['defaultNamingContext'][0]
+        except (ldap.LDAPError, IndexError, KeyError):
+            return None
+
+    @staticmethod
+    def _naming_context(dn):
+        """
+        :param dn: A distinguished name
+        :return: The trailing DC= components of the distinguished name. Example: 'DC=mydomain,DC=com'
+        """
+        rdns = ldap.dn.str2dn(dn)
+        index = len(rdns)
+        while index > 0 and rdns[index - 1][0][0].lower() == 'dc':
+            index -= 1
+        return ldap.dn.dn2str(rdns[index:])
+
+    @staticmethod
+    def _users_to_members(userdns, users):
+        """
+        :param userdns: A list of distinguished names of users in Active Directory
+        :param users: A dictionary of user DN to the users Active Directory attributes
+        :return: A list of dictionaries {'dn', 'username', 'first_name', 'last_name', 'mail'} in the order of userdns
+
+        Users that were not found or are missing an attribute are left out
+        python-ldap returns UTF-8 encoded byte strings, the attributes are decoded so they compare equal to the
+        unicode values Django reads back from the database
+        """
+        members = []
+        for userdn in userdns:
+            user = users.get(userdn)
+            if user and all(attribute in user for attribute in USER_ATTRIBUTES):
+                members.append({'dn': userdn,
+                                'username': LDAPAPI._text(user['sAMAccountName'][0]).lower(),
+                                'first_name': LDAPAPI._text(user['givenName'][0]),
+                                'last_name': LDAPAPI._text(user['sn'][0]),
+                                'mail': LDAPAPI._text(user['mail'][0])})
+        return members
+
+    @staticmethod
+    def _text(value):
+        """
+        :param value: An attribute value from python-ldap
+        :return: The value as unicode
+        """
+        return value.decode('utf-8') if isinstance(value, str) else value
+
     @staticmethod
     def _connect(ldap_uri, ldap_username, ldap_password):
         """
@@ -78,39 +596,473 @@ class LDAPAPI(object):
         """
         ldap_connection.unbind()  # Unbind connection
 
+    def _search(self, ldap_uri, ldap_username, ldap_password, base, scope, filterstr='(objectClass=*)', attrlist=None):
+        """
+        :param ldap_uri: The uri to the AD Domain
+        :param ldap_username: The username of the bind account
+        :param ldap_password: The password of the bind account
+        :return: The result of search_s run on a pooled connection
+
+        If a reused idle connection was dropped by the server the search is retried once on a fresh bind, the pool
+        discards the other idle connections to the server so the retry does not pick up another dropped one
+        A server that can not be bound to or drops a fresh connection fails the search straight away
+        """
+        try:
+            with self.connection_pool.connection(ldap_uri, ldap_username, ldap_password,
+                                                 report=self.report) as ldap_connection:
+                self._incr('ldap_searches')
+                return ldap_connection.search_s(base, scope, filterstr, attrlist)
+        except ldap.SERVER_DOWN:
+            if not self.connection_pool.reused():
+                raise
+            with self.connection_pool.connection(ldap_uri, ldap_username, ldap_password,
+                                                 report=self.report) as ldap_connection:
+                self._incr('ldap_searches')
+                return ldap_connection.search_s(base, scope, filterstr, attrlist)
+
+    def _paged_search(self, ldap_uri, ldap_username, ldap_password, base, scope, filterstr='(objectClass=*)',
+                      attrlist=None):
+        """
+        :param ldap_uri: The uri to the AD Domain
+        :param ldap_username: The username of the bind account
+        :param ldap_password: The password of the bind account
+        :return: A generator of lists of (dn, attributes) results, at most page_size entries each
+
+        Uses the Simple Paged Results control so searches returning more entries than the servers MaxPageSize
+        are not truncated. The pooled connection is held until the last page has been read
+        """
+        page_control = SimplePagedResultsControl(True, size=self.page_size, cookie='')
+        with self.connection_pool.connection(ldap_uri, ldap_username, ldap_password,
+                                             report=self.report) as ldap_connection:
+            while True:
+                self._incr('ldap_searches')
+                msgid = ldap_connection.search_ext(base, scope, filterstr, attrlist, serverctrls=[page_control])
+                result_type, result_data, result_msgid, result_controls = ldap_connection.result3(msgid)
+                yield [(dn, attributes) for dn, attributes in result_data if dn]  # Skip search continuation references
+
+                page_control.cookie = self._paged_results_cookie(result_controls)
+                if not page_control.cookie:
+                    break
+
+    def _search_many(self, ldap_uri, ldap_username, ldap_password, searches):
+        """
+        :param ldap_uri: The uri to the AD Domain
+        :param ldap_username: The username of the bind account
+        :param ldap_password: The password of the bind account
+        :param searches: A list of (base, scope, filterstr, attrlist) tuples
+        :return: A list with the list of (dn, attributes) results or the ldap.LDAPError of each search, in the order of searches
+
+        Sends the searches on one pooled connection using the asynchronous search_ext message IDs of python-ldap, so
+        many searches are in flight at once from a single thread. At most pipeline_depth searches are outstanding,
+        and no more than the max_connections_per_uri of the connection pool when it is set, the next search is sent
+        as soon as the oldest result is read
+        Each search carries the Simple Paged Results control, further pages are sent once the previous page is in
+        Raises ldap.LDAPError if the connection itself fails
+        """
+        depth = min(self.pipeline_depth, self.connection_pool.max_connections_per_uri or self.pipeline_depth)
+        search_results = [[] for search in searches]
+        in_flight = deque()  # (index of the search, msgid) in the order they were sent
+        next_index = 0
+        with self.connection_pool.connection(ldap_uri, ldap_username, ldap_password,
+                                             report=self.report) as ldap_connection:
+            while next_index < len(searches) or in_flight:
+                while next_index < len(searches) and len(in_flight) < depth:
+                    in_flight.append((next_index, self._send_search(ldap_connection, searches[next_index], cookie='')))
+                    next_index += 1
+
+                index, msgid = in_flight.popleft()
+                try:
+                    result_type, result_data, result_msgid, result_controls = ldap_connection.result3(msgid)
+                    search_results[index].extend((dn, attributes) for dn, attributes in result_data if dn)
+                    cookie = self._paged_results_cookie(result_controls)
+                    if cookie:
+                        in_flight.append((index, self._send_search(ldap_connection, searches[index], cookie=cookie)))
+                except ldap.SERVER_DOWN:
+                    raise
+                except ldap.LDAPError, error:
+                    search_results[index] = error
+        return search_results
+
+    def _send_search(self, ldap_connection, search, cookie):
+        """
+        :param ldap_connection: A bound ldap connection object
+        :param search: A (base, scope, filterstr, attrlist) tuple
+        :param cookie: The Simple Paged Results cookie of the page to read, empty for the first page
+        :return: The message ID of the search
+        """
+        base, scope, filterstr, attrlist = search
+        self._incr('ldap_searches')
+        return ldap_connection.search_ext(base, scope, filterstr, attrlist,
+                                          serverctrls=[SimplePagedResultsControl(True, size=self.page_size,
+                                                                                 cookie=cookie)])
+
+    @staticmethod
+    def _paged_results_cookie(result_controls):
+        """
+        :param result_controls: The response controls returned by result3
+        :return: The Simple Paged Results cookie, empty when there are no more pages
+        """
+        cookies = [control.cookie for control in result_controls
+                   if control.controlType == SimplePagedResultsControl.controlType]
+        return cookies[0] if cookies else ''
+
+    def _member_range_attribute(self, low):
+        return 'member;range={0}-{1}'.format(low, low + self.page_size - 1)
+
+    @staticmethod
+    def _member_range(groupdn_result):
+        """
+        :param groupdn_result: The result of a base search on a group for a ranged member attribute
+        :return: A tuple with the list of member DNs in the range and the low bound of the next range,
+                 or None if this was the last range
+        """
+        if not groupdn_result:
+            return [], None
+
+        for attribute, member_dns in groupdn_result[0][1].items():
+            attribute_name, _, attribute_range = attribute.partition(';')
+            if attribute_name.lower() == 'member':
+                break
+        else:
+            return [], None  # The group has no members
+
+        if not attribute_range or attribute_range.endswith('-*'):
+            return member_dns, None
+        return member_dns, int(attribute_range.rsplit('-', 1)[1]) + 1
+
+    @_timed('ldap_group_search')
+    def get_groups_member_dns(self, group_dns):
+        """
+        :param group_dns: A list of distinguished names of groups on the primary server
+        :return: A dictionary of group DN to a tuple with status of True or False, and a list of member DNs or an error message
+
+        Reads the member attribute of every group with ranged retrieval like iter_group_member_dns, but sends the
+        next range of every group together with _search_many so the reads of many groups are in flight at once
+        When nested_groups is True the nested groups are expanded once and shared between the groups
+        """
+        group_results = {}
+        member_dns_by_group = dict((group_dn, []) for group_dn in group_dns)
+        lows = dict((group_dn, 0) for group_dn in group_dns)
+        while lows:
+            pending = lows.items()
+            try:
+                search_results = self._search_many(self.ldap_uri, self.ldap_username, self.ldap_password,
+                                                   [(group_dn, ldap.SCOPE_BASE, '(objectClass=*)',
+                                                     [self._member_range_attribute(low)]) for group_dn, low in pending])
+            except ldap.LDAPError, error:
+                search_results = [error] * len(pending)
+
+            lows = {}
+            for (group_dn, low), search_result in zip(pending, search_results):
+                if isinstance(search_result, ldap.LDAPError):
+                    group_results[group_dn] = (False, u"LDAP lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=search_result))
+                    continue
+                member_dns, next_low = self._member_range(search_result)
+                member_dns_by_group[group_dn].extend(member_dns)
+                if next_low is None:
+                    group_results[group_dn] = (True, member_dns_by_group.pop(group_dn))
+                else:
+                    lows[group_dn] = next_low
+
+        if self.nested_groups:
+            # Look up which direct members of all the groups are groups together before expanding each group
+            try:
+                self._group_dns([member_dn for status, member_dns in group_results.values() if status
+                                 for member_dn in member_dns])
+            except LDAPLookupError:
+                pass  # The DNs that could not be looked up are looked up again, and fail, only for their own groups
+            for group_dn, (status, member_dns) in group_results.items():
+                if not status:
+                    continue
+                try:
+                    group_results[group_dn] = (True, [member_dn for page_member_dns in
+                                                      self._iter_nested_member_dns(member_dns, set([group_dn.lower()]))
+                                                      for member_dn in page_member_dns])
+                except LDAPLookupError, error:
+                    group_results[group_dn] = (False, unicode(error))
+        return group_results
+
+    def iter_group_member_dns(self, basedn="OU=Groups,OU=TDBFG,DC=TDBFG,DC=com", groupdn="CN=IDBD_SCE_Approver"):
+        """
+        :param basedn: A base dn is the point from where a server will search for groups. Example: 'dc=example,dc=com'.
+        :param groupdn: The distinguished Name of the group to search for in Active Directory.
+        :return: A generator of lists of member DNs, at most page_size DNs each unless nested_groups is True
+
+        Active Directory returns at most MaxValRange (1500) values of the member attribute in one read
+        The member attribute is read with ranged retrieval 'member;range=low-high' until the last range 'low-*'
+        When nested_groups is True members that are groups are replaced by their own members, see _iter_nested_member_dns
+        Raises LDAPLookupError with an error message if the lookup fails
+        """
+        seen_dns = set(["{groupdn},{basedn}".format(groupdn=groupdn, basedn=basedn).lower()])
+        low = 0
+        while low is not None:
+            try:
+                with self._phase('ldap_group_search'):
+                    groupdn_result = self._search(self.ldap_uri, self.ldap_username, self.ldap_password,
+                                                  "{groupdn},{basedn}".format(groupdn=groupdn, basedn=basedn),
+                                                  ldap.SCOPE_BASE,
+                                                  attrlist=[self._member_range_attribute(low)])
+            except ldap.LDAPError, error:
+                raise LDAPLookupError(u"LDAP lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error))
+
+            member_dns, low = self._member_range(groupdn_result)
+            if self.nested_groups:
+                for nested_member_dns in self._iter_nested_member_dns(member_dns, seen_dns):
+                    yield nested_member_dns
+            elif member_dns:
+                yield member_dns
+
+    def _iter_nested_member_dns(self, member_dns, seen_dns):
+        """
+        :param member_dns: A list of member DNs of a group
+        :param seen_dns: A set of the lowercased DNs already returned or expanded, it is updated as members are found
+        :return: A generator of lists of member DNs that are not groups, breadth first through the nested groups
+
+        Every DN is returned or expanded once, so members reached through several groups are not repeated and
+        membership cycles end. The members of each nested group are kept for the life of the LDAPAPI, a group
+        nested in many groups is only read once
+        Raises LDAPLookupError with an error message if a nested group could not be read
+        """
+        pending = deque([member_dns])
+        while pending:
+            member_dns = pending.popleft()
+            group_dns = self._group_dns(member_dns)
+            user_dns = []
+            for member_dn in member_dns:
+                if member_dn.lower() in seen_dns:
+                    continue
+                seen_dns.add(member_dn.lower())
+                if member_dn.lower() in group_dns:
+                    pending.append(self._nested_group_member_dns(member_dn))
+                else:
+                    user_dns.append(member_dn)
+            if user_dns:
+                yield user_dns
+
+    @_timed('ldap_group_search')
+    def _group_dns(self, dns):
+        """
+        :param dns: A list of distinguished names of group members
+        :return: A set of the lowercased DNs that are groups
+
+        The DNs of each naming context are searched for with objectClass group, one search per chunk_size DNs, on
+        the server the domain router gives for it. DNs of a naming context no server holds are taken to not be groups
+        Raises LDAPLookupError with an error message if every server failed with an error other than a referral or
+        missing base, so a nested group is never taken for a user and its members removed
+        """
+        dns_by_naming_context = {}
+        for dn in dns:
+            if dn.lower() not in self._is_group_by_dn:
+                dns_by_naming_context.setdefault(self._naming_context(dn), []).append(dn)
+
+        for naming_context, naming_context_dns in dns_by_naming_context.items():
+            for index in range(0, len(naming_context_dns), self.chunk_size):
+                chunk = naming_context_dns[index:index + self.chunk_size]
+                filterstr = '(&(objectClass=group){0})'.format(self._users_filter(chunk))
+                server_error = None
+                for ldap_server in self.domain_router.servers_for(self, naming_context):
+                    try:
+                        group_search_result = self._search(ldap_uri=ldap_server.get('uri'),
+                                                           ldap_username=ldap_server.get('username'),
+                                                           ldap_password=ldap_server.get('password'),
+                                                           base=naming_context,
+                                                           scope=ldap.SCOPE_SUBTREE,
+                                                           filterstr=filterstr,
+                                                           attrlist=['1.1'])
+                    except ldap.LDAPError, error:
+                        self._server_failed(naming_context, ldap_server, error)
+                        if not isinstance(error, (ldap.REFERRAL, ldap.NO_SUCH_OBJECT)):
+                            server_error = error
+                        continue
+                    self.domain_router.answered(naming_context, ldap_server)
+                    found_dns = set(dn.lower() for dn, _ in group_search_result if dn)
+                    self._is_group_by_dn.update((dn.lower(), dn.lower() in found_dns) for dn in chunk)
+                    break
+                else:
+                    if server_error is not None:
+                        raise LDAPLookupError(u"LDAP nested group lookup failed. {LDAP_ERROR}".format(
+                            LDAP_ERROR=server_error))
+                    self._is_group_by_dn.update((dn.lower(), False) for dn in chunk)
+
+        return set(dn.lower() for dn in dns if self._is_group_by_dn[dn.lower()])
+
+    @_timed('ldap_group_search')
+    def _nested_group_member_dns(self, groupdn):
+        """
+        :param groupdn: The distinguished name of a nested group
+        :return: A list of the member DNs of the group
+
+        The member attribute is read with ranged retrieval on the server the domain router gives for the naming
+        context of the group, nested groups can be in another domain than the group they are a member of
+        Raises LDAPLookupError with an error message if no server could read the group
+        """
+        if groupdn.lower() not in self._member_dns_by_group:
+            naming_context = self._naming_context(groupdn)
+            error = u"No LDAP server holds {0}".format(naming_context)
+            for ldap_server in self.domain_router.servers_for(self, naming_context):
+                member_dns = []
+                low = 0
+                try:
+                    while low is not None:
+                        groupdn_result = self._search(ldap_uri=ldap_server.get('uri'),
+                                                      ldap_username=ldap_server.get('username'),
+                                                      ldap_password=ldap_server.get('password'),
+                                                      base=groupdn,
+                                                      scope=ldap.SCOPE_BASE,
+                                                      attrlist=[self._member_range_attribute(low)])
+                        page_member_dns, low = self._member_range(groupdn_result)
+                        member_dns.extend(page_member_dns)
+                except ldap.LDAPError, error:
+                    self._server_failed(naming_context, ldap_server, error)
+                    continue
+                self.domain_router.answered(naming_context, ldap_server)
+                break
+            else:
+                raise LDAPLookupError(u"LDAP nested group lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error))
+            self._member_dns_by_group[groupdn.lower()] = member_dns
+        return self._member_dns_by_group[groupdn.lower()]
+
+    def iter_group_members(self, basedn="OU=Groups,OU=TDBFG,DC=TDBFG,DC=com", groupdn="CN=IDBD_SCE_Approver"):
+        """
+        :param basedn: A base dn is the point from where a server will search for groups. Example: 'dc=example,dc=com'.
+        :param groupdn: The distinguished Name of the group to search for in Active Directory.
+        :return: A generator of lists of group members with dictionary of there properties, one list per page of members
+
+        Members are read and resolved one page at a time so only a single page is held in memory
+        Raises LDAPLookupError with an error message if the lookup fails part way through the group
+        """
+        try:
+            for member_dns in self.iter_group_member_dns(basedn=basedn, groupdn=groupdn):
+                for group_members in self.iter_members(userdns=member_dns):
+                    yield group_members
+        except LDAPLookupError:
+            raise
+        except ldap.LDAPError, error:
+            raise LDAPLookupError(u"LDAP lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error))
+        except Exception:
+            raise LDAPLookupError(u"Unknown LDAP error has occurred.")
+
+    def iter_members(self, userdns):
+        """
+        :param userdns: A list of distinguished names of users in Active Directory
+        :return: A generator of lists of members with dictionary of there properties, one list per page_size DNs
+
+        Raises LDAPLookupError with an error message if the lookup fails
+        """
+        for index in range(0, len(userdns), self.page_size):
+            page_userdns = userdns[index:index + self.page_size]
+            status, users = self.get_users_attributes(userdns=page_userdns)
+            if not status:
+                raise LDAPLookupError(users)
+            yield self._users_to_members(page_userdns, users)
+
+    def iter_changed_members(self, userdns, highest_committed_usns, changed_dns=None):
+        """
+        :param userdns: A list of distinguished names of users in Active Directory
+        :param highest_committed_usns: The highest committed USNs of a previous run, see get_highest_committed_usns
+        :param changed_dns: Optional. A set the DNs of every changed user found are added to, including the users
+                            left out of the members because they are missing an attribute
+        :return: A generator of lists of members with dictionary of there properties, for the users in userdns
+                 whose uSNChanged is above the highestCommittedUSN of the server they were read from
+
+        uSNChanged is local to each domain controller, so each naming context is searched on the server the domain
+        router gives for it, the same as get_users_attributes. Servers without a USN are skipped
+        Raises LDAPLookupError with an error message if no server could be searched for a naming context
+        """
+        userdns_by_naming_context = {}
+        for userdn in userdns:
+            userdns_by_naming_context.setdefault(self._naming_context(userdn), []).append(userdn)
+
+        for naming_context, naming_context_userdns in userdns_by_naming_context.items():
+            requested_userdns = dict((userdn.lower(), userdn) for userdn in naming_context_userdns)
+            error = u"No server with a highestCommittedUSN for {0}".format(naming_context)
+            for ldap_server in self.domain_router.servers_for(self, naming_context):
+                if ldap_server.get('uri') not in highest_committed_usns:
+                    continue
+                filterstr = '(&(objectClass=user)(uSNChanged>={0}))'.format(
+                    highest_committed_usns[ldap_server.get('uri')]['usn'] + 1)
+                try:
+                    page_started = time.time()
+                    for user_search_result in self._paged_search(ldap_uri=ldap_server.get('uri'),
+                                                                 ldap_username=ldap_server.get('username'),
+                                                                 ldap_password=ldap_server.get('password'),
+                                                                 base=naming_context,
+                                                                 scope=ldap.SCOPE_SUBTREE,
+                                                                 filterstr=filterstr,
+                                                                 attrlist=USER_ATTRIBUTES):
+                        if self.report is not None:
+                            self.report.add_time('ldap_member_lookup', time.time() - page_started)
+                        users = dict((requested_userdns[userdn.lower()], user_dictionary)
+                                     for userdn, user_dictionary in user_search_result
+                                     if userdn.lower() in requested_userdns)
+                        if changed_dns is not None:
+                            changed_dns.update(users)
+                        if self.user_cache is not None:
+                            self.user_cache.set_many(users)
+                        yield self._users_to_members(users.keys(), users)
+                        page_started = time.time()
+                    break
+                except ldap.LDAPError, error:
+                    self._server_failed(naming_context, ldap_server, error)
+                    continue
+            else:
+                raise LDAPLookupError(u"LDAP changed user lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error))
+
+    def get_highest_committed_usns(self):
+        """
+        :return: A tuple with status of True or False, and a dictionary of server uri to a dictionary
+                 {'usn', 'server'} of the highestCommittedUSN and dsServiceName read from the rootDSE of the primary
+                 server and each referral, or an error message
+
+        USNs are local to each domain controller and a uri can resolve to any domain controller of the domain,
+        the dsServiceName tells which domain controller the USN came from
+        """
+        highest_committed_usns = {}
+        for ldap_server in self._ldap_servers():
+            try:
+                root_dse_result = self._search(ldap_uri=ldap_server.get('uri'),
+                                               ldap_username=ldap_server.get('username'),
+                                               ldap_password=ldap_server.get('password'),
+                                               base='',
+                                               scope=ldap.SCOPE_BASE,
+                                               attrlist=['highestCommittedUSN', 'dsServiceName'])
+                highest_committed_usns[ldap_server.get('uri')] = {
+                    'usn': int(root_dse_result[0][1]['highestCommittedUSN'][0]),
+                    'server': self._text(root_dse_result[0][1]['dsServiceName'][0])}
+            except ldap.LDAPError, error:
+                return False, u"LDAP highestCommittedUSN lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error)
+            except (IndexError, KeyError, ValueError):
+                return False, u"LDAP server {0} did not return a highestCommittedUSN and dsServiceName.".format(ldap_server.get('uri'))
+        return True, highest_committed_usns
+
+    @_timed('ldap_group_search')
+    def get_usn_changed(self, dn):
+        """
+        :param dn: A distinguished name of an object on the primary server
+        :return: A tuple with status of True or False, and the uSNChanged of the object or an error message
+        """
+        try:
+            search_result = self._search(self.ldap_uri, self.ldap_username, self.ldap_password, dn, ldap.SCOPE_BASE,
+                                         attrlist=['uSNChanged'])
+            return True, int(search_result[0][1]['uSNChanged'][0])
+        except ldap.LDAPError, error:
+            return False, u"LDAP uSNChanged lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error)
+        except (IndexError, KeyError, ValueError):
+            return False, u"LDAP object {0} has no uSNChanged.".format(dn)
+
     def get_group_members(self, basedn="OU=Groups,OU=TDBFG,DC=TDBFG,DC=com", groupdn="CN=IDBD_SCE_Approver"):
         """
         :param basedn: A base dn is the point from where a server will search for groups. Example: 'dc=example,dc=com'.
         :param groupdn: The distinguished Name of the group to search for in Active Directory.
         :return: Tuple with status of True or False and a list of group members with dictionary of there properties or an error message
         """
-        ldap_connection = {}
         group_members = []
 
         try:
-            ldap_connection = self._connect(self.ldap_uri, self.ldap_username, self.ldap_password)
-            groupdn_result = ldap_connection.search_s("{groupdn},{basedn}".format(groupdn=groupdn, basedn=basedn),
-                                                      ldap.SCOPE_BASE)
-        except ldap.LDAPError, error:
-            return False, u"LDAP lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error)
-        except:
-            return False, u"Unknown LDAP error has occurred."
-
-        if groupdn_result:
-            groupdn_result = groupdn_result[0][1]
-
-            if groupdn_result.get('member'):
-                for member in groupdn_result.get('member'):
-                    status, user = self.get_user_attributes(userdn=member)
-                    if status and user:
-                        if 'sAMAccountName' and 'givenName' and 'sn' and 'mail' in user:
-                            group_members.append({'username': user['sAMAccountName'][0].lower(),
-                                                  'first_name': user['givenName'][0],
-                                                  'last_name': user['sn'][0],
-                                                  'mail': user['mail'][0]})
-         # Disconnect current LDAP session
-        if ldap_connection:
-            self._ldap_disconnect(ldap_connection)
+            for page_group_members in self.iter_group_members(basedn=basedn, groupdn=groupdn):
+                group_members.extend(page_group_members)
+        except LDAPLookupError, error:
+            return False, unicode(error)
 
         if group_members:
             return True, group_members
@@ -122,37 +1074,203 @@ class LDAPAPI(object):
         :param userdn: A distinguished name of a user in Active Directory
         :return: A tuple with status of True or False, and a dictionary of the users Active Directory attributes
         """
-        ldap_connection = None
         user_search_result = {}
+        naming_context = self._naming_context(userdn)
+        error = u"No LDAP server holds {0}".format(naming_context)
+
+        for ldap_server in self.domain_router.servers_for(self, naming_context):
+            try:
+                user_search_result = self._search(ldap_uri=ldap_server.get('uri'),
+                                                  ldap_username=ldap_server.get('username'),
+                                                  ldap_password=ldap_server.get('password'),
+                                                  base=userdn,
+                                                  scope=ldap.SCOPE_SUBTREE)
+            except ldap.LDAPError, error:
+                self._server_failed(naming_context, ldap_server, error)
+                continue
+            except:
+                return False, u"Unknown LDAP error has occurred while getting user attributes."
+            self.domain_router.answered(naming_context, ldap_server)
+            break
+        else:
+            return False, u"LDAP user lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error)
+
+        if user_search_result:
+            user_dictionary = user_search_result[0][1]  # [0] = List of results; [1] = Dict of attributes
+            return True, user_dictionary
+        else:
+            return False, {}
+
+    @_timed('ldap_member_lookup')
+    def get_users_attributes(self, userdns, chunk_size=None):
+        """
+        :param userdns: An iterable of distinguished names of users in Active Directory
+        :param chunk_size: The number of users to resolve with each search. Defaults to the chunk_size of LDAPAPI.
+        :return: A tuple with status of True or False, and a dictionary of user DN to the users Active Directory attributes
+
+        Resolves many users at once by grouping the DNs by naming context and sending one OR filtered search per chunk
+        When pipeline is True the chunks for each server are sent together on one connection, see _search_many
+        When max_workers is above 1 the chunks are searched concurrently on the thread pool of the LDAPAPI, each search
+        uses its own pooled connection and the connection pool caps the searches in flight per URI
+        The chunks searched one at a time stop at the first chunk that fails, so a server that is down is not
+        connected to again for each of its chunks
+        Only USER_ATTRIBUTES are requested. DNs that could not be found on any server are left out of the dictionary
+        Users found in the user_cache are not looked up, users that are looked up are added to the user_cache
+        """
+        chunk_size = chunk_size or self.chunk_size
+        userdns = list(userdns)
+        cached_users = self.user_cache.get_many(userdns) if self.user_cache is not None else {}
+        if self.user_cache is not None:
+            self._incr('user_cache_hits', len(cached_users))
+            self._incr('user_cache_misses', len(userdns) - len(cached_users))
+
+        userdns_by_naming_context = {}
+        for userdn in userdns:
+            if userdn not in cached_users:
+                userdns_by_naming_context.setdefault(self._naming_context(userdn), []).append(userdn)
 
+        chunks = []
+        for naming_context, naming_context_userdns in userdns_by_naming_context.items():
+            for index in range(0, len(naming_context_userdns), chunk_size):
+                chunks.append((naming_context, naming_context_userdns[index:index + chunk_size]))
+
+        if self.pipeline and len(chunks) > 1:
+            chunk_results = self._pipeline_search_users_chunks(chunks)
+        elif self.max_workers > 1 and len(chunks) > 1:
+            chunk_results = self._thread_pool().map(self._try_search_users_chunk, chunks)
+        else:
+            chunk_results = self._search_users_chunks_until_failure(chunks)
+
+        users = {}
+        for status, chunk_users in chunk_results:
+            if not status:
+                return False, chunk_users
+            users.update(chunk_users)
+
+        if self.user_cache is not None:
+            self.user_cache.set_many(users)
+        users.update(cached_users)
+        return True, users
+
+    def _pipeline_search_users_chunks(self, chunks):
+        """
+        :param chunks: A list of tuples of a naming context and a list of distinguished names of users in it
+        :return: A list with a tuple with status of True or False, and the users or an error message for each chunk
+
+        The chunks are sent together with _search_many to the first server the domain router gives for them
+        Chunks whose pipelined search failed are retried one at a time, up to the first one that fails again
+        The results are not in the order of chunks
+        """
+        chunk_results = [None] * len(chunks)
+        ldap_servers = {}
+        chunk_indexes_by_uri = {}
+        for index, (naming_context, userdns) in enumerate(chunks):
+            naming_context_servers = self.domain_router.servers_for(self, naming_context)
+            if naming_context_servers:
+                ldap_servers[naming_context_servers[0].get('uri')] = naming_context_servers[0]
+                chunk_indexes_by_uri.setdefault(naming_context_servers[0].get('uri'), []).append(index)
+
+        for ldap_uri, chunk_indexes in chunk_indexes_by_uri.items():
+            ldap_server = ldap_servers[ldap_uri]
+            searches = [(chunks[index][0], ldap.SCOPE_SUBTREE, self._users_filter(chunks[index][1]), USER_ATTRIBUTES)
+                        for index in chunk_indexes]
+            try:
+                search_results = self._search_many(ldap_server.get('uri'), ldap_server.get('username'),
+                                                   ldap_server.get('password'), searches)
+            except ldap.LDAPError:
+                continue
+            for index, search_result in zip(chunk_indexes, search_results):
+                naming_context, userdns = chunks[index]
+                if isinstance(search_result, ldap.LDAPError):
+                    self._server_failed(naming_context, ldap_server, search_result)
+                    continue
+                self.domain_router.answered(naming_context, ldap_server)
+                chunk_results[index] = (True, self._match_users(userdns, search_result))
+
+        retry_chunks = [chunk for chunk, chunk_result in zip(chunks, chunk_results) if chunk_result is None]
+        return [chunk_result for chunk_result in chunk_results if chunk_result is not None] \
+            + self._search_users_chunks_until_failure(retry_chunks)
+
+    def _search_users_chunks_until_failure(self, chunks):
+        """
+        :param chunks: A list of tuples of a naming context and a list of distinguished names of users in it
+        :return: A list with a tuple with status of True or False, and the users or an error message for each chunk
+                 searched, the last one is the first failure and the chunks after it are not searched
+        """
+        chunk_results = []
+        for chunk in chunks:
+            chunk_results.append(self._try_search_users_chunk(chunk))
+            if not chunk_results[-1][0]:
+                break
+        return chunk_results
+
+    @staticmethod
+    def _users_filter(userdns):
+        """
+        :param userdns: A list of distinguished names of users
+        :return: An OR filter matching the distinguishedName of every user
+        """
+        return '(|{0})'.format(''.join('(distinguishedName={0})'.format(ldap.filter.escape_filter_chars(userdn))
+                                       for userdn in userdns))
+
+    @staticmethod
+    def _match_users(userdns, user_search_result):
+        """
+        :param userdns: A list of distinguished names of users
+        :param user_search_result: A list of (dn, attributes) results
+        :return: A dictionary of user DN, as given in userdns, to the users Active Directory attributes
+        """
+        requested_userdns = dict((userdn.lower(), userdn) for userdn in userdns)
+        return dict((requested_userdns[userdn.lower()], user_dictionary)
+                    for userdn, user_dictionary in user_search_result if userdn.lower() in requested_userdns)
+
+    def _try_search_users_chunk(self, chunk):
+        """
+        :param chunk: A tuple of the naming context and a list of distinguished names of users in the naming context
+        :return: A tuple with status of True or False, and the result of _search_users_chunk or an error message
+
+        Chunks whose naming context no server holds resolve to no users, the same as a failed single user lookup
+        Any other LDAP error, such as the server of the naming context being down, fails the lookup so the users are
+        not taken for removed from the group
+        """
         try:
-            ldap_connection = self._connect(ldap_uri=self.ldap_uri,
-                                            ldap_username=self.ldap_username,
-                                            ldap_password=self.ldap_password)
-            user_search_result = ldap_connection.search_s(userdn, ldap.SCOPE_SUBTREE)
+            return True, self._search_users_chunk(*chunk)
+        except (ldap.REFERRAL, ldap.NO_SUCH_OBJECT):
+            return True, {}
         except ldap.LDAPError, error:
-            for ldap_referral in self.ldap_referrals:
-                try:
-                    ldap_connection = self._connect(ldap_uri=ldap_referral.get('uri'),
-                                                    ldap_username=ldap_referral.get('username'),
-                                                    ldap_password=ldap_referral.get('password'))
-                    user_search_result = ldap_connection.search_s(userdn, ldap.SCOPE_SUBTREE)
-                    break
-                except ldap.LDAPError, error:
-                    return False, u"LDAP user lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error)
-                except:
-                    return False, u"Unknown LDAP error has occurred while getting user attributes."
-            else:
-                return False, u"LDAP user lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error)
+            return False, u"LDAP user lookup failed. {LDAP_ERROR}".format(LDAP_ERROR=error)
         except:
             return False, u"Unknown LDAP error has occurred while getting user attributes."
 
-        # Disconnect current LDAP session
-        if ldap_connection:
-            self._ldap_disconnect(ldap_connection)
+    def _search_users_chunk(self, naming_context, userdns):
+        """
+        :param naming_context: The naming context all of the DNs belong to. Example: 'DC=mydomain,DC=com'
+        :param userdns: A list of distinguished names of users in the naming context
+        :return: A dictionary of user DN to the users Active Directory attributes
 
-        if user_search_result:
-            user_dictionary = user_search_result[0][1]  # [0] = List of results; [1] = Dict of attributes
-            return True, user_dictionary
-        else:
-            return False, {}
\ No newline at end of file
+        Searches the server the domain router gives for the naming context. If every server failed the last error
+        other than a referral or missing base is raised, or the last ldap.REFERRAL or ldap.NO_SUCH_OBJECT if there was none
+        """
+        filterstr = self._users_filter(userdns)
+        last_error = ldap.REFERRAL({'desc': 'No LDAP server holds {0}'.format(naming_context)})
+        server_error = None
+        for ldap_server in self.domain_router.servers_for(self, naming_context):
+            users = {}
+            try:
+                for user_search_result in self._paged_search(ldap_uri=ldap_server.get('uri'),
+                                                             ldap_username=ldap_server.get('username'),
+                                                             ldap_password=ldap_server.get('password'),
+                                                             base=naming_context,
+                                                             scope=ldap.SCOPE_SUBTREE,
+                                                             filterstr=filterstr,
+                                                             attrlist=USER_ATTRIBUTES):
+                    users.update(self._match_users(userdns, user_search_result))
+            except ldap.LDAPError, error:
+                self._server_failed(naming_context, ldap_server, error)
+                last_error = error
+                if not isinstance(error, (ldap.REFERRAL, ldap.NO_SUCH_OBJECT)):
+                    server_error = error
+                continue
+            self.domain_router.answered(naming_context, ldap_server)
+            return users
+        raise server_error or last_error
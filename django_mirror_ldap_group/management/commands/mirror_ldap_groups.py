@@ -0,0 +1,60 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django_mirror_ldap_group.mirror_ldap_group import NotificationQueue
+from django_mirror_ldap_group.scheduler import MirrorScheduler
+
+
+class Command(BaseCommand):
+    """
+    Mirrors the LDAP groups in settings.MIRROR_LDAP_GROUPS with the MirrorScheduler
+
+    Settings:
+    MIRROR_LDAP_GROUPS - A list of dictionaries of MirrorLDAPGroup init parameters for each group
+    MIRROR_LDAP_GROUP_OPTIONS - A dictionary of the MirrorLDAPGroup init parameters shared by every group. Without a
+                                notification_queue the notifications of all the groups are sent as digests at the end
+    MIRROR_LDAP_GROUPS_MAX_WORKERS - The number of groups mirrored at once. Default: 1
+    MIRROR_LDAP_GROUPS_LOCK_DIR - The directory of the group lock files. Default: the temporary directory
+    MIRROR_LDAP_GROUPS_BACKOFF - Seconds to wait before mirroring an unchanged group again. Default: 300
+    MIRROR_LDAP_GROUPS_MAX_BACKOFF - The longest wait in seconds between runs of an unchanged group. Default: 3600
+    """
+    help = u"Mirrors the LDAP groups in settings.MIRROR_LDAP_GROUPS to Django groups"
+    args = u"[group_name ...]"
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help=u"The number of groups mirrored at once. Overrides MIRROR_LDAP_GROUPS_MAX_WORKERS."),
+        make_option('--force', action='store_true', dest='force', default=False,
+                    help=u"Mirror the groups even if they are backing off."),
+    )
+
+    def handle(self, *group_names, **options):
+        ldap_groups = getattr(settings, 'MIRROR_LDAP_GROUPS', None)
+        if not ldap_groups:
+            raise CommandError(u"Must set MIRROR_LDAP_GROUPS to a list of dictionaries! "
+                               u"Example: [{'ldap_group_name': 'IDBD_SCE_Approvers'},]")
+        unknown_group_names = set(group_names) - set(ldap_group.get('ldap_group_name') for ldap_group in ldap_groups)
+        if unknown_group_names:
+            raise CommandError(u"Groups not in MIRROR_LDAP_GROUPS: {0}".format(u", ".join(sorted(unknown_group_names))))
+
+        group_options = dict(getattr(settings, 'MIRROR_LDAP_GROUP_OPTIONS', {}))
+        group_options.setdefault('notification_queue', NotificationQueue())
+        try:
+            scheduler = MirrorScheduler(ldap_groups=ldap_groups,
+                                        options=group_options,
+                                        max_workers=options.get('workers') or getattr(settings,
+                                                                                      'MIRROR_LDAP_GROUPS_MAX_WORKERS', 1),
+                                        lock_dir=getattr(settings, 'MIRROR_LDAP_GROUPS_LOCK_DIR', None),
+                                        backoff=getattr(settings, 'MIRROR_LDAP_GROUPS_BACKOFF', 300),
+                                        max_backoff=getattr(settings, 'MIRROR_LDAP_GROUPS_MAX_BACKOFF', 3600))
+        except ValueError, error:
+            raise CommandError(unicode(error))
+
+        failed = False
+        for group_name, status, message in scheduler.run(group_names=group_names or None, force=options.get('force')):
+            if status is False:
+                failed = True
+                self.stderr.write(message)
+            else:
+                self.stdout.write(message)
+        if failed:
+            raise CommandError(u"One or more groups failed to mirror.")
@@ -1,6 +1,27 @@
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from django.contrib.auth.models import User, Group
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections, router, transaction
+from django.utils import timezone
 from django_mirror_ldap_group import ldapapi
+from django_mirror_ldap_group.models import LDAPGroupSyncState
+from django_mirror_ldap_group.report import MirrorReport
+
+
+logger = logging.getLogger(__name__)
+
+
+# MirrorLDAPGroup init parameters that configure the LDAPAPI, MirrorLDAPGroups shares one LDAPAPI between its groups
+LDAPAPI_OPTIONS = ['ldap_uri', 'ldap_username', 'ldap_password', 'ldap_referrals', 'ldap_chunk_size', 'ldap_page_size',
+                   'ldap_user_cache', 'ldap_max_workers', 'ldap_max_connections_per_uri', 'ldap_pipeline',
+                   'ldap_pipeline_depth', 'ldap_nested_groups', 'ldap_domain_router']
+# MirrorLDAPGroup init parameters of the incremental mode, MirrorLDAPGroups always runs a full mirror
+INCREMENTAL_OPTIONS = ['incremental', 'full_resync_interval']
 
 
 class MirrorLDAPGroup():
@@ -23,20 +44,48 @@ class MirrorLDAPGroup():
                  notify_from_email_address=None,
                  notify_portal_name=None,
                  notify_portal_link=None,
-                 notify_custom_message=u''):
+                 notify_custom_message=u'',
+                 ldap_chunk_size=100,
+                 ldap_page_size=1000,
+                 db_batch_size=500,
+                 incremental=False,
+                 full_resync_interval=86400,
+                 ldap_user_cache=None,
+                 ldap_max_workers=1,
+                 ldap_max_connections_per_uri=None,
+                 ldap_pipeline=False,
+                 ldap_pipeline_depth=10,
+                 ldap_nested_groups=False,
+                 ldap_domain_router=None,
+                 notification_queue=None,
+                 report_hooks=()):
         """
         :param ldap_group_base_dn: A base dn is the point from where a server will search for groups. Example: 'dc=example,dc=com'.
         :param ldap_uri: The uri to the AD Domain where the group exists.
         :param ldap_username: The username of the bind account where the group exists.
         :param ldap_password: The password of the bind account where the group exists.
         :param ldap_group_name: The name of the group to search for in Active Directory.
-        :param ldap_referrals: A list with dictionary(s) containing connection information for any AD Domain Controllers you wish to check. Example: [{'uri': '', 'username': '', 'password': ''},].
+        :param ldap_referrals: A list with dictionary(s) containing connection information for any AD Domain Controllers you wish to check. Example: [{'uri': '', 'username': '', 'password': ''},]. An optional 'naming_context' key routes the DNs of that domain straight to the server, otherwise it is read from the servers rootDSE.
         :param notify_new_user_added: True or False sends emails to selected email addresses notifying of new users.
         :param notify_to_email_addresses: Required if notify_new_user_added True. List of String email addresses.
         :param notify_from_email_address: Required if notify_new_user_added True. Sting email address.
         :param notify_portal_name: Required if notify_new_user_added True. Name of the portal.
         :param notify_portal_link: Required if notify_new_user_added True. Link to the portal.
         :param notify_custom_message: Optional if notify_new_user_added True. String message.
+        :param ldap_chunk_size: The number of group members to resolve with each LDAP search.
+        :param ldap_page_size: The number of group members to read from the group and from each paged LDAP search.
+        :param db_batch_size: The maximum number of group members written to the database at a time.
+        :param incremental: True or False only mirror the changes since the previous run. Requires django_mirror_ldap_group in INSTALLED_APPS.
+        :param full_resync_interval: Required if incremental True. Seconds between full mirrors that correct any drift.
+        :param ldap_user_cache: Optional. An ldapapi user cache, LocMemUserCache or DjangoUserCache, to keep user attributes between runs.
+        :param ldap_max_workers: The number of threads resolving group members concurrently.
+        :param ldap_max_connections_per_uri: Optional. The maximum number of LDAP requests in flight at once to each URI.
+        :param ldap_pipeline: True or False send the member lookups for each server together on one connection instead of one at a time.
+        :param ldap_pipeline_depth: Required if ldap_pipeline True. The maximum number of lookups in flight at once on the connection, ldap_max_connections_per_uri caps it as well.
+        :param ldap_nested_groups: True or False mirror the members of groups nested in the group, at any depth, instead of only its direct members.
+        :param ldap_domain_router: Optional. An ldapapi DomainRouter to keep the server of each naming context between runs. By default the servers are routed again on each run.
+        :param notification_queue: Optional if notify_new_user_added True. A NotificationQueue to add the notification to instead of sending it at the end of the run.
+        :param report_hooks: A list of callables called with the MirrorReport of each run. Example: [report.LoggingReportHook(), report.StatsdReportHook(statsd_client)].
         :return: Nothing
         """
         # Required options
@@ -47,6 +96,21 @@ class MirrorLDAPGroup():
         self.ldap_group_name = ldap_group_name
         self.ldap_referrals = ldap_referrals
         # Optional options
+        self.ldap_chunk_size = ldap_chunk_size
+        self.ldap_page_size = ldap_page_size
+        self.db_batch_size = db_batch_size
+        self.incremental = incremental
+        self.full_resync_interval = full_resync_interval
+        self.ldap_user_cache = ldap_user_cache
+        self.ldap_max_workers = ldap_max_workers
+        self.ldap_max_connections_per_uri = ldap_max_connections_per_uri
+        self.ldap_pipeline = ldap_pipeline
+        self.ldap_pipeline_depth = ldap_pipeline_depth
+        self.ldap_nested_groups = ldap_nested_groups
+        self.ldap_domain_router = ldap_domain_router
+        self.notification_queue = notification_queue
+        self.report_hooks = report_hooks
+        self.report = None  # The MirrorReport of the last run
         self.notify_new_user_added = notify_new_user_added
         if self.notify_new_user_added:
             self.notify_to_email_addresses = notify_to_email_addresses
@@ -163,32 +227,351 @@ class MirrorLDAPGroup():
 
         This function is to be executed after init parameters are passed
         What this functions does:
-        1. Gets group membership user information from ldapapi
+        1. Streams group membership user information from ldapapi one page at a time
         2. Creates the group if it doesnt already exists in Django
-        3. Adds or updates users in Django from AD and associates them to the corresponding group
-        4. Removes users from Django group that no longer exist in AD
+        3. Adds or updates users in Django from AD and associates them to the corresponding group, one batch at a time
+        4. Removes users from Django group that no longer exist in AD, once the whole group has been read
         5. Returns the status True or False and a message
+
+        If the LDAP lookup fails part way the batches already written are kept but no users are removed
+        When incremental is True only the changes since the previous run are read, see _mirror_incremental
+        The timings and counters of the run are kept in self.report and passed to the report_hooks
+        """
+        groupdn = "CN={GROUP_NAME}".format(GROUP_NAME=self.ldap_group_name)
+        new_users = []
+        removed_users = []
+        self.report = MirrorReport(name=self.ldap_group_name)
+
+        with self.report.run():
+            with self._ldapapi() as ldap:
+                try:
+                    if self.incremental:
+                        status, result = self._mirror_incremental(ldap=ldap, groupdn=groupdn, new_users=new_users,
+                                                                  removed_users=removed_users)
+                    else:
+                        status, result, usernames_by_dn = self._mirror_full(ldap=ldap, groupdn=groupdn,
+                                                                            new_users=new_users,
+                                                                            removed_users=removed_users)
+                except ldapapi.LDAPLookupError, error:
+                    status, result = False, unicode(error)
+                finally:
+                    self._notify(new_users=new_users, removed_users=removed_users)
+
+        status, message = self._result_message(status=status, result=result)
+        self.report.finish(status=status, message=message, hooks=self.report_hooks)
+        return status, message
+
+    def plan_ldap_group(self, using=None):
+        """
+        :param using: Optional. The database alias to read the Django users from, a read replica for example.
+        :return: Tuple with status of True or False and a plan dictionary or a message
+
+        Works out what mirror_ldap_group would change without writing to the database
+        Every member is read from LDAP, then the Django users and the group are read in one transaction, a read only
+        REPEATABLE READ snapshot on PostgreSQL so every batch sees the same commits, see _read_snapshot
+        The plan is a JSON serializable dictionary:
+        {'group_name': 'IDBD_SCE_Approvers',
+         'create': [[username, first_name, last_name, email], ...],  Users that do not exist in Django
+         'update': [[username, first_name, last_name, email], ...],  Users whose attributes changed in AD
+         'add': [username, ...],  Users to add to the group
+         'remove': [username, ...]}  Users to remove from the group
+        Pass the plan, or the plan loaded back from JSON, to apply_plan
         """
         groupdn = "CN={GROUP_NAME}".format(GROUP_NAME=self.ldap_group_name)
+        self.report = MirrorReport(name=self.ldap_group_name)
+
+        with self.report.run():
+            try:
+                with self._ldapapi() as ldap:
+                    ldap_group_members = [member for page in ldap.iter_group_members(basedn=self.ldap_group_base_dn,
+                                                                                     groupdn=groupdn)
+                                          for member in page]
+            except ldapapi.LDAPLookupError, error:
+                status, result = False, unicode(error)
+            else:
+                if ldap_group_members:
+                    using = using or router.db_for_read(User)
+                    with self._read_snapshot(using=using):
+                        result = self._plan_members(ldap_group_members=ldap_group_members, using=using)
+                        result['remove'] = self._plan_removals(
+                            ldap_group_usernames=set(member.get('username') for member in ldap_group_members),
+                            using=using)
+                    result['group_name'] = self.ldap_group_name
+                    status = True
+                else:
+                    status, result = False, u"LDAP lookup failed to find AD group members."
+
+        if status:
+            message = u"{GROUP_NAME} Planned! Create {CREATE}, update {UPDATE}, add {ADD} and remove {REMOVE} users." \
+                .format(GROUP_NAME=self.ldap_group_name, CREATE=len(result['create']), UPDATE=len(result['update']),
+                        ADD=len(result['add']), REMOVE=len(result['remove']))
+        else:
+            status, message = self._result_message(status=status, result=result)
+            result = message
+        self.report.finish(status=status, message=message, hooks=self.report_hooks)
+        return status, result
+
+    def apply_plan(self, plan):
+        """
+        :param plan: A plan dictionary from plan_ldap_group of this group
+        :return: Tuple with status of True or False and a message
 
-        ldap = ldapapi.LDAPAPI(ldap_uri=self.ldap_uri,
+        Writes the whole plan in bulk inside one transaction, no LDAP lookups are made
+        The plan can be applied by another process than the one that made it and after the database changed, users
+        created since are updated instead and memberships already added or removed are skipped
+        """
+        if plan.get('group_name') != self.ldap_group_name:
+            raise ValueError(u"The plan is for group {0}, not {1}!".format(plan.get('group_name'), self.ldap_group_name))
+
+        new_users = []
+        removed_users = []
+        self.report = MirrorReport(name=self.ldap_group_name)
+
+        with self.report.run():
+            with transaction.atomic():
+                group_object = self._get_or_create_group()
+                new_users.extend(self._apply_members(plan=plan, group_object=group_object))
+                started = time.time()
+                removed_count = self._apply_removals(usernames=plan['remove'], group_object=group_object,
+                                                     removed_users=removed_users)
+                removed_seconds = time.time() - started
+            self._notify(new_users=new_users, removed_users=removed_users)
+
+        status, message = self._result_message(status=True, result=(removed_count, removed_seconds))
+        self.report.finish(status=status, message=message, hooks=self.report_hooks)
+        return status, message
+
+    def _incr(self, counter, count=1):
+        if self.report is not None:
+            self.report.incr(counter, count)
+
+    @contextmanager
+    def _phase(self, phase):
+        if self.report is None:
+            yield
+        else:
+            with self.report.phase(phase):
+                yield
+
+    @staticmethod
+    @contextmanager
+    def _read_snapshot(using):
+        """
+        :param using: The database alias to read from
+        :return: A context manager running the reads inside it in one transaction
+
+        On PostgreSQL the transaction is made read only with REPEATABLE READ isolation, so all of its queries read
+        the same snapshot instead of each seeing the commits made before it under the default READ COMMITTED
+        MySQL InnoDB reads a snapshot by default, other backends only get the transaction
+        Inside a transaction the caller already opened the isolation level can no longer change and is left alone
+        """
+        connection = connections[using]
+        set_isolation = connection.vendor == 'postgresql' and not connection.in_atomic_block
+        with transaction.atomic(using=using):
+            if set_isolation:
+                connection.cursor().execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            yield
+
+    def _notify(self, new_users, removed_users, notification_queue=None):
+        """
+        :param new_users: A list of descriptions of the users newly added to the group
+        :param removed_users: A list of the usernames removed from the group
+        :param notification_queue: Optional. The NotificationQueue to use instead of the notification_queue of the init parameters
+        :return: Nothing
+
+        Adds the changes to the notification queue, without a queue the new users are emailed straight away
+        """
+        if not self.notify_new_user_added:
+            return
+        notification_queue = notification_queue or self.notification_queue
+        with self._phase('notify'):
+            if notification_queue is not None:
+                notification_queue.add(mirror=self, new_users=new_users, removed_users=removed_users)
+            elif new_users:
+                self._notify_new_user_added_function(usernames=new_users, groupname=self.ldap_group_name)
+
+    def _ldapapi(self):
+        """
+        :return: An LDAPAPI instance configured with the init parameters
+        """
+        return ldapapi.LDAPAPI(ldap_uri=self.ldap_uri,
                                ldap_username=self.ldap_username,
                                ldap_password=self.ldap_password,
-                               ldap_referrals=self.ldap_referrals)
+                               ldap_referrals=self.ldap_referrals,
+                               chunk_size=self.ldap_chunk_size,
+                               page_size=self.ldap_page_size,
+                               user_cache=self.ldap_user_cache,
+                               max_workers=self.ldap_max_workers,
+                               max_connections_per_uri=self.ldap_max_connections_per_uri,
+                               pipeline=self.ldap_pipeline,
+                               pipeline_depth=self.ldap_pipeline_depth,
+                               nested_groups=self.ldap_nested_groups,
+                               domain_router=self.ldap_domain_router,
+                               report=self.report)
+
+    def _result_message(self, status, result):
+        """
+        :param status: True or False
+        :param result: The result of _remove_non_existing_users or an error message
+        :return: Tuple with status of True or False and a message
+        """
+        if not status:
+            return False, u"{GROUP_NAME} Mirroring Failed! {ERROR_MESSAGE}".format(GROUP_NAME=self.ldap_group_name,
+                                                                                   ERROR_MESSAGE=result)
 
-        ldap_status, ldap_group_members = ldap.get_group_members(basedn=self.ldap_group_base_dn, groupdn=groupdn)
+        removed_count, removed_seconds = result
+        return True, u"{GROUP_NAME} Mirrored Successfully! " \
+                     u"Removed {REMOVED_COUNT} users in {REMOVED_SECONDS:.3f} seconds.".format(
+                         GROUP_NAME=self.ldap_group_name,
+                         REMOVED_COUNT=removed_count,
+                         REMOVED_SECONDS=removed_seconds)
+
+    def _mirror_full(self, ldap, groupdn, new_users, removed_users=None):
+        """
+        :param ldap: An LDAPAPI instance
+        :param groupdn: The distinguished Name of the group to mirror
+        :param new_users: A list the descriptions of users newly added to the group are appended to
+        :param removed_users: Optional. A list the usernames removed from the group are appended to
+        :return: Tuple with status of True or False, the result of _remove_non_existing_users or an error message,
+                 and a dictionary of member DN to username
+
+        Reads and mirrors every member of the group
+        """
+        pages = ldap.iter_group_members(basedn=self.ldap_group_base_dn, groupdn=groupdn)
+        group_object, usernames_by_dn = self._write_members(pages=pages, new_users=new_users)
+        if group_object is None:
+            return False, u"LDAP lookup failed to find AD group members.", None
 
-        # To view the returned values uncomment below
-        #print ldap_group_members
+        removed = self._remove_non_existing_users(ldap_group_usernames=set(usernames_by_dn.values()),
+                                                  group_object=group_object,
+                                                  removed_users=removed_users)
+        return True, removed, usernames_by_dn
 
-        if ldap_status:
-            group_object = self._get_or_create_group()
-            self._add_or_update_users(ldap_group_members=ldap_group_members, group_object=group_object)
-            self._remove_non_existing_users(ldap_group_members=ldap_group_members, group_object=group_object)
-            return True, u"{GROUP_NAME} Mirrored Successfully!".format(GROUP_NAME=self.ldap_group_name)
+    def _mirror_incremental(self, ldap, groupdn, new_users, removed_users=None):
+        """
+        :param ldap: An LDAPAPI instance
+        :param groupdn: The distinguished Name of the group to mirror
+        :param new_users: A list the descriptions of users newly added to the group are appended to
+        :param removed_users: Optional. A list the usernames removed from the group are appended to
+        :return: Tuple with status of True or False and the result of _remove_non_existing_users or an error message
+
+        Uses the highestCommittedUSN of each server and the member DNs stored by the previous run as a high-water mark
+        1. The member DNs are only read again if the uSNChanged of the group moved past the mark or nested groups are mirrored
+        2. Only new or unresolved member DNs and members whose uSNChanged moved past the mark are resolved and written,
+           a changed member that no longer resolves is removed
+        3. Stale users are removed against the stored usernames of every member
+        A full mirror is run instead on the first run, when the servers or the domain controllers they resolve to
+        changed, since USNs are local to each domain controller, or every full_resync_interval seconds
+        """
+        now = timezone.now()
+        status, highest_committed_usns = ldap.get_highest_committed_usns()
+        if not status:
+            return False, highest_committed_usns
+
+        sync_state = LDAPGroupSyncState.objects.filter(group_name=self.ldap_group_name).first()
+        if sync_state is None or sync_state.ldap_uri != self.ldap_uri \
+                or self._usn_servers(sync_state.get_highest_committed_usns()) != self._usn_servers(highest_committed_usns) \
+                or (now - sync_state.last_full_sync).total_seconds() >= self.full_resync_interval:
+            status, result, usernames_by_dn = self._mirror_full(ldap=ldap, groupdn=groupdn, new_users=new_users,
+                                                                removed_users=removed_users)
+            if status:
+                sync_state = sync_state or LDAPGroupSyncState(group_name=self.ldap_group_name)
+                sync_state.last_full_sync = now
+                self._save_sync_state(sync_state, highest_committed_usns, usernames_by_dn, now)
+            return status, result
+
+        previous_highest_committed_usns = sync_state.get_highest_committed_usns()
+        usernames_by_dn = sync_state.get_usernames_by_dn()
+
+        group_full_dn = "{groupdn},{basedn}".format(groupdn=groupdn, basedn=self.ldap_group_base_dn)
+        status, group_usn_changed = ldap.get_usn_changed(dn=group_full_dn)
+        if not status:
+            return False, group_usn_changed
+
+        # A change to a nested group does not change the uSNChanged of the group, so nested members are always read
+        if self.ldap_nested_groups or group_usn_changed > previous_highest_committed_usns[self.ldap_uri]['usn']:
+            member_dns = set()
+            for page_member_dns in ldap.iter_group_member_dns(basedn=self.ldap_group_base_dn, groupdn=groupdn):
+                member_dns.update(page_member_dns)
+            for removed_dn in set(usernames_by_dn) - member_dns:
+                del usernames_by_dn[removed_dn]
+            added_dns = [member_dn for member_dn in member_dns if usernames_by_dn.get(member_dn) is None]
         else:
-            return False, u"{GROUP_NAME} Mirroring Failed! {ERROR_MESSAGE}".format(GROUP_NAME=self.ldap_group_name,
-                                                                                   ERROR_MESSAGE=ldap_group_members)
+            added_dns = []
+
+        # Unresolved members are searched for changes as well, so they are picked up once they can be resolved
+        added_dn_set = set(added_dns)
+        existing_dns = [member_dn for member_dn in usernames_by_dn if member_dn not in added_dn_set]
+        changed_dns = set()
+        pages = itertools.chain(ldap.iter_members(userdns=added_dns),
+                                ldap.iter_changed_members(userdns=existing_dns,
+                                                          highest_committed_usns=previous_highest_committed_usns,
+                                                          changed_dns=changed_dns))
+        group_object, changed_usernames_by_dn = self._write_members(pages=pages, new_users=new_users)
+        # Members that can not be resolved, or no longer can be after a change, are left out of the group
+        usernames_by_dn.update((member_dn, None) for member_dn in itertools.chain(added_dns, changed_dns))
+        usernames_by_dn.update(changed_usernames_by_dn)
+
+        ldap_group_usernames = set(username for username in usernames_by_dn.values() if username)
+        if not ldap_group_usernames:
+            return False, u"LDAP lookup failed to find AD group members."
+
+        removed = self._remove_non_existing_users(ldap_group_usernames=ldap_group_usernames,
+                                                  group_object=group_object or self._get_or_create_group(),
+                                                  removed_users=removed_users)
+        self._save_sync_state(sync_state, highest_committed_usns, usernames_by_dn, now)
+        return True, removed
+
+    @staticmethod
+    def _usn_servers(highest_committed_usns):
+        """
+        :param highest_committed_usns: The highest committed USNs of a run, see LDAPAPI.get_highest_committed_usns
+        :return: A dictionary of server uri to the dsServiceName of the domain controller the USN was read from
+        """
+        return dict((uri, usn.get('server') if isinstance(usn, dict) else None)
+                    for uri, usn in highest_committed_usns.items())
+
+    def _save_sync_state(self, sync_state, highest_committed_usns, usernames_by_dn, now):
+        sync_state.ldap_uri = self.ldap_uri
+        sync_state.set_highest_committed_usns(highest_committed_usns)
+        sync_state.set_usernames_by_dn(usernames_by_dn)
+        sync_state.last_sync = now
+        sync_state.save()
+
+    def _write_members(self, pages, new_users):
+        """
+        :param pages: An iterable of lists of group members from ldapapi
+        :param new_users: A list the descriptions of users newly added to the group are appended to
+        :return: A tuple with the Django group or None if there were no members, and a dictionary of member DN to username
+        """
+        group_object = None
+        usernames_by_dn = {}
+        for ldap_group_members in self._batches(pages, self.db_batch_size):
+            if group_object is None:
+                group_object = self._get_or_create_group()
+            new_users.extend(self._add_or_update_users(ldap_group_members=ldap_group_members,
+                                                       group_object=group_object))
+            usernames_by_dn.update((member.get('dn'), member.get('username')) for member in ldap_group_members)
+        return group_object, usernames_by_dn
+
+    @staticmethod
+    def _batches(pages, batch_size):
+        """
+        :param pages: An iterable of lists of group members
+        :param batch_size: The maximum number of group members in each batch
+        :return: A generator of lists of group members with at most batch_size members each
+
+        Regroups the pages returned by ldapapi so database writes happen in bounded batches as pages arrive
+        """
+        batch = []
+        for page in pages:
+            for member in page:
+                batch.append(member)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
 
     def _get_or_create_group(self):
         group, created = Group.objects.get_or_create(name=self.ldap_group_name)
@@ -198,37 +581,150 @@ class MirrorLDAPGroup():
         """
         :param ldap_group_members: A list of users with properties in a dictionary {'username', 'first_name', 'last_name', 'mail'}
         :param group_object: An model object instance of a Django group
-        :return: Nothing
+        :return: A list of descriptions of the users newly added to the group
 
         Add or update AD group members
+        The changes are worked out as sets with _plan_members and written in bulk with _apply_members
         """
+        return self._apply_members(plan=self._plan_members(ldap_group_members=ldap_group_members),
+                                   group_object=group_object)
+
+    def _plan_members(self, ldap_group_members, using=None):
+        """
+        :param ldap_group_members: A list of users with properties in a dictionary {'username', 'first_name', 'last_name', 'mail'}
+        :param using: Optional. The database alias to read the Django users from.
+        :return: A dictionary with the create, update and add lists of a plan, see plan_ldap_group
+
+        Only reads, the existing users and group memberships are loaded with one query each per db_batch_size members
+        """
+        members = OrderedDict((member.get('username'), member) for member in ldap_group_members)
+        usernames = members.keys()
+        users = {}
+        group_usernames = set()
+        for index in range(0, len(usernames), self.db_batch_size):
+            batch_usernames = usernames[index:index + self.db_batch_size]
+            users.update((username, [first_name, last_name, email]) for username, first_name, last_name, email in
+                         User.objects.using(using).filter(username__in=batch_usernames)
+                                                  .values_list('username', 'first_name', 'last_name', 'email'))
+            group_usernames.update(User.objects.using(using).filter(groups__name=self.ldap_group_name,
+                                                                    username__in=batch_usernames)
+                                                            .values_list('username', flat=True))
+
+        plan = {'create': [], 'update': [], 'add': []}
+        for username, member in members.items():
+            attributes = [member.get('first_name'), member.get('last_name'), member.get('mail')]
+            if username not in users:
+                plan['create'].append([username] + attributes)
+            elif users[username] != attributes:
+                plan['update'].append([username] + attributes)
+            if username not in group_usernames:
+                plan['add'].append(username)
+        return plan
+
+    def _apply_members(self, plan, group_object):
+        """
+        :param plan: A dictionary with the create, update and add lists of a plan, see plan_ldap_group
+        :param group_object: An model object instance of a Django group
+        :return: A list of descriptions of the users newly added to the group
+
+        Writes the plan in bulk inside one transaction, db_batch_size users at a time
+        Django 1.6 has no bulk_update so each changed user is one UPDATE
+        The plan may be older than the database, users created since are updated instead and members already in the
+        group are skipped
+        """
+        group_membership_model = User.groups.through
         new_users = []
-        for member in ldap_group_members:
-            user, created = User.objects.get_or_create(username=member.get('username'),
-                                                       first_name=member.get('first_name'),
-                                                       last_name=member.get('last_name'),
-                                                       email=member.get('mail'))
-            if user not in group_object.user_set.all():
-                group_object.user_set.add(user)
-                new_users.append(u'{0} {1} ({2})'.format(user.first_name, user.last_name, user.username))
 
-        if self.notify_new_user_added and new_users:
-            self._notify_new_user_added_function(usernames=new_users,
-                                                 groupname=self.ldap_group_name)
+        with self._phase('db_write'), transaction.atomic():
+            users_to_update = list(plan['update'])
+            for batch in self._batches([plan['create']], self.db_batch_size):
+                existing_users = dict((user[0], list(user[1:])) for user in
+                                      User.objects.filter(username__in=[user[0] for user in batch])
+                                                  .values_list('username', 'first_name', 'last_name', 'email'))
+                users_to_create = [User(username=username, first_name=first_name, last_name=last_name, email=email)
+                                   for username, first_name, last_name, email in batch
+                                   if username not in existing_users]
+                User.objects.bulk_create(users_to_create)
+                self._incr('users_created', len(users_to_create))
+                users_to_update.extend(user for user in batch
+                                       if user[0] in existing_users and existing_users[user[0]] != list(user[1:]))
+
+            for username, first_name, last_name, email in users_to_update:
+                User.objects.filter(username=username).update(first_name=first_name, last_name=last_name, email=email)
+            self._incr('users_updated', len(users_to_update))
+
+            for batch in self._batches([plan['add']], self.db_batch_size):
+                users = list(User.objects.filter(username__in=batch).values_list('pk', 'username', 'first_name',
+                                                                                  'last_name'))
+                group_user_ids = set(group_membership_model.objects.filter(group=group_object,
+                                                                           user__in=[user[0] for user in users])
+                                                                   .values_list('user_id', flat=True))
+                users_to_add = [user for user in users if user[0] not in group_user_ids]
+                group_membership_model.objects.bulk_create([group_membership_model(user_id=user_id,
+                                                                                   group_id=group_object.pk)
+                                                            for user_id, username, first_name, last_name in users_to_add])
+                self._incr('users_added', len(users_to_add))
+                new_users.extend(u'{0} {1} ({2})'.format(first_name, last_name, username)
+                                 for user_id, username, first_name, last_name in users_to_add)
+
+        return new_users
+
+    def _remove_non_existing_users(self, ldap_group_usernames, group_object, removed_users=None):
+        """
+        :param ldap_group_usernames: A set of the usernames of every AD group member
+        :param group_object: An model object instance of a Django group
+        :param removed_users: Optional. A list the usernames removed from the group are appended to
+        :return: A tuple with the number of users removed from the group and the seconds the removal took
 
-    def _remove_non_existing_users(self, ldap_group_members, group_object):
+        Usernames are compared case folded, the same as the lowered sAMAccountName given by ldapapi
+        Stale users are removed with one user_set.remove per db_batch_size users
         """
-        :param ldap_group_members: A list of users with properties in a dictionary {'username', 'first_name', 'last_name', 'mail'}
+        started = time.time()
+        ldap_group_usernames = set(username.lower() for username in ldap_group_usernames)
+
+        with self._phase('db_write'):
+            group_users = User.objects.filter(groups=group_object).values_list('pk', 'username')
+            stale_users = [(user_id, username) for user_id, username in group_users
+                           if username.lower() not in ldap_group_usernames]
+            stale_user_ids = [user_id for user_id, username in stale_users]
+            for index in range(0, len(stale_user_ids), self.db_batch_size):
+                group_object.user_set.remove(*stale_user_ids[index:index + self.db_batch_size])
+        self._incr('users_removed', len(stale_user_ids))
+        if removed_users is not None:
+            removed_users.extend(username for user_id, username in stale_users)
+
+        return len(stale_user_ids), time.time() - started
+
+    def _plan_removals(self, ldap_group_usernames, using=None):
+        """
+        :param ldap_group_usernames: A set of the usernames of every AD group member
+        :param using: Optional. The database alias to read the group from.
+        :return: A list of the usernames in the Django group that are not AD group members
+        """
+        ldap_group_usernames = set(username.lower() for username in ldap_group_usernames)
+        group_usernames = User.objects.using(using).filter(groups__name=self.ldap_group_name) \
+                                                   .values_list('username', flat=True)
+        return [username for username in group_usernames if username.lower() not in ldap_group_usernames]
+
+    def _apply_removals(self, usernames, group_object, removed_users=None):
+        """
+        :param usernames: A list of the usernames to remove from the group
         :param group_object: An model object instance of a Django group
-        :return: Nothing
+        :param removed_users: Optional. A list the usernames removed from the group are appended to
+        :return: The number of users removed from the group
         """
-        users = User.objects.filter(groups__name=self.ldap_group_name)
-        for user in users:
-            for member in ldap_group_members:
-                if str(user.username) == str(member.get('username')):
-                    break
-            else:
-                group_object.user_set.remove(user)
+        removed_count = 0
+        with self._phase('db_write'):
+            for batch in self._batches([usernames], self.db_batch_size):
+                stale_users = list(User.objects.filter(groups=group_object, username__in=batch)
+                                               .values_list('pk', 'username'))
+                if stale_users:
+                    group_object.user_set.remove(*[user_id for user_id, username in stale_users])
+                removed_count += len(stale_users)
+                if removed_users is not None:
+                    removed_users.extend(username for user_id, username in stale_users)
+        self._incr('users_removed', removed_count)
+        return removed_count
 
     def _notify_new_user_added_function(self, usernames, groupname):
         """
@@ -263,4 +759,251 @@ class MirrorLDAPGroup():
                                       LINK=self.notify_portal_link,)
         msg = EmailMessage(subject, html_content, self.notify_from_email_address, self.notify_to_email_addresses)
         msg.content_subtype = "html"  # Main content is now text/html
-        msg.send()
\ No newline at end of file
+        msg.send()
+
+
+class MirrorLDAPGroups():
+    """
+    Mirrors many Active Directory groups to Django groups in one run
+
+    The member DNs of every group are read first, each distinct DN is resolved once for all of the groups
+    and the Django group changes of all groups are applied in one transaction
+    Pass ldap_user_cache in options to also reuse the resolved users between runs
+    The notifications of all the groups are sent as digests over one mail connection at the end of the run, unless a
+    notification_queue is given in options
+    One MirrorReport covers the whole run, it is kept in self.report and passed to the report_hooks in options
+
+    Call the function 'mirror_ldap_groups' to perform the mirroring it will return a status and message per group
+    """
+    def __init__(self, ldap_groups, **options):
+        """
+        :param ldap_groups: A list of dictionaries with the keys ldap_group_name and ldap_group_base_dn, any other MirrorLDAPGroup init parameter in a dictionary overrides options for that group, except the LDAPAPI_OPTIONS. Example: [{'ldap_group_name': 'IDBD_SCE_Approvers', 'ldap_group_base_dn': 'OU=Groups,DC=ACME,DC=com'},].
+        :param options: The MirrorLDAPGroup init parameters shared by every group. The LDAPAPI_OPTIONS are only taken from options. The INCREMENTAL_OPTIONS are not supported, use MirrorLDAPGroup to mirror a group incrementally.
+        :return: Nothing
+        """
+        if not ldap_groups or not isinstance(ldap_groups, (tuple, list)):
+            raise ValueError(u"Must enter ldap_groups as a list of dictionaries! "
+                             u"Example: [{'ldap_group_name': 'IDBD_SCE_Approvers', "
+                             u"'ldap_group_base_dn': 'OU=Groups,DC=ACME,DC=com'},]")
+        for ldap_group in ldap_groups:
+            ldap_group_options = sorted(set(ldap_group) & set(LDAPAPI_OPTIONS))
+            if ldap_group_options:
+                raise ValueError(u"The LDAP options of every group are shared, pass {0} in options instead of "
+                                 u"ldap_groups!".format(u", ".join(ldap_group_options)))
+        incremental_options = sorted(set(options).union(*ldap_groups) & set(INCREMENTAL_OPTIONS))
+        if incremental_options:
+            raise ValueError(u"MirrorLDAPGroups always runs a full mirror, remove {0} or mirror the groups with "
+                             u"MirrorLDAPGroup!".format(u", ".join(incremental_options)))
+        self.mirrors = [MirrorLDAPGroup(**dict(options, **ldap_group)) for ldap_group in ldap_groups]
+        self.options = options
+        self.report = None  # The MirrorReport of the last run
+
+    def mirror_ldap_groups(self):
+        """
+        :return: A list with a tuple with status of True or False and a message for each group, in the order of ldap_groups
+
+        What this functions does:
+        1. Reads the member DNs of every group from ldapapi, with the reads of many groups in flight at once
+        2. Resolves each distinct member DN once, for all groups at the same time
+        3. Adds, updates and removes the users of every Django group inside one transaction
+        """
+        self.report = MirrorReport(name=u', '.join(mirror.ldap_group_name for mirror in self.mirrors))
+        for mirror in self.mirrors:
+            mirror.report = self.report
+
+        with self.report.run():
+            results = self._mirror_ldap_groups()
+
+        self.report.finish(status=all(status for status, message in results),
+                           message=u'\n'.join(message for status, message in results),
+                           hooks=self.options.get('report_hooks', ()))
+        return results
+
+    def _mirror_ldap_groups(self):
+        """
+        :return: A list with a tuple with status of True or False and a message for each group, in the order of ldap_groups
+        """
+        results = [None] * len(self.mirrors)
+        members_by_dn = {}
+        member_dns_by_mirror = {}
+
+        # Every mirror has the same LDAPAPI_OPTIONS, see __init__
+        with self.mirrors[0]._ldapapi() as ldap:
+            group_dns = ["CN={GROUP_NAME},{BASE_DN}".format(GROUP_NAME=mirror.ldap_group_name,
+                                                            BASE_DN=mirror.ldap_group_base_dn)
+                         for mirror in self.mirrors]
+            group_results = ldap.get_groups_member_dns(group_dns=group_dns)
+            for index, group_dn in enumerate(group_dns):
+                status, member_dns = group_results[group_dn]
+                if status:
+                    member_dns_by_mirror[index] = member_dns
+                else:
+                    results[index] = (False, member_dns)
+
+            unresolved_dns = set()
+            for member_dns in member_dns_by_mirror.values():
+                unresolved_dns.update(member_dns)
+            # Member DNs shared by more than one group are only resolved once
+            self.report.incr('shared_member_hits', sum(len(member_dns) for member_dns in member_dns_by_mirror.values())
+                             - len(unresolved_dns))
+            unresolved_dns = list(unresolved_dns)
+            try:
+                for ldap_group_members in ldap.iter_members(userdns=unresolved_dns):
+                    members_by_dn.update((member.get('dn'), member) for member in ldap_group_members)
+            except ldapapi.LDAPLookupError, error:
+                return [mirror._result_message(*(result or (False, unicode(error))))
+                        for mirror, result in zip(self.mirrors, results)]
+
+        new_users_by_mirror = {}
+        removed_users_by_mirror = {}
+        with transaction.atomic():
+            for index, member_dns in member_dns_by_mirror.items():
+                mirror = self.mirrors[index]
+                ldap_group_members = [members_by_dn[member_dn] for member_dn in member_dns
+                                      if member_dn in members_by_dn]
+                if not ldap_group_members:
+                    results[index] = (False, u"LDAP lookup failed to find AD group members.")
+                    continue
+
+                group_object = mirror._get_or_create_group()
+                new_users_by_mirror[index] = []
+                removed_users_by_mirror[index] = []
+                for batch in mirror._batches([ldap_group_members], mirror.db_batch_size):
+                    new_users_by_mirror[index].extend(mirror._add_or_update_users(ldap_group_members=batch,
+                                                                                  group_object=group_object))
+                results[index] = (True, mirror._remove_non_existing_users(
+                    ldap_group_usernames=set(member.get('username') for member in ldap_group_members),
+                    group_object=group_object,
+                    removed_users=removed_users_by_mirror[index]))
+
+        notification_queue = NotificationQueue()
+        for index, new_users in new_users_by_mirror.items():
+            self.mirrors[index]._notify(new_users=new_users, removed_users=removed_users_by_mirror[index],
+                                        notification_queue=self.mirrors[index].notification_queue or notification_queue)
+        with self.report.phase('notify'):
+            notification_queue.flush()
+
+        return [mirror._result_message(*result) for mirror, result in zip(self.mirrors, results)]
+
+
+class NotificationQueue(object):
+    """
+    Collects the users added to and removed from groups and emails them as digests
+
+    The changes of every group with the same sender, recipients and portal are merged into one email and all of the
+    emails are sent over one mail connection when the queue is flushed
+    Pass a queue as notification_queue to MirrorLDAPGroup so the mirror does not wait on the mail server, then call
+    flush() once the groups have been mirrored, or set debounce so the queue flushes itself in a background thread
+    The debounce thread is not a daemon, a process that exits sooner waits for it so the pending digests are still sent
+    """
+    def __init__(self, debounce=None, notify_removed_users=False, connection=None, fail_silently=False):
+        """
+        :param debounce: Optional. Seconds without a new change after which the queue is flushed in a background thread. By default the queue is only sent by flush().
+        :param notify_removed_users: True or False include the users removed from each group in the digests.
+        :param connection: Optional. A Django mail connection to send the digests with. By default one is opened with get_connection() for each flush.
+        :param fail_silently: True or False ignore errors sending the digests.
+        :return: Nothing
+        """
+        self.debounce = debounce
+        self.notify_removed_users = notify_removed_users
+        self.connection = connection
+        self.fail_silently = fail_silently
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, mirror, new_users, removed_users=()):
+        """
+        :param mirror: The MirrorLDAPGroup the changes were made by, its notify init parameters address the digest
+        :param new_users: A list of descriptions of the users newly added to the group
+        :param removed_users: A list of the usernames removed from the group
+        :return: Nothing
+        """
+        removed_users = removed_users if self.notify_removed_users else ()
+        if not new_users and not removed_users:
+            return
+
+        key = (mirror.notify_from_email_address, tuple(mirror.notify_to_email_addresses), mirror.notify_portal_name,
+               mirror.notify_portal_link, mirror.notify_custom_message)
+        with self._lock:
+            changes = self._pending.setdefault(key, OrderedDict()).setdefault(mirror.ldap_group_name,
+                                                                             (OrderedDict(), OrderedDict()))
+            changes[0].update((new_user, True) for new_user in new_users)
+            changes[1].update((removed_user, True) for removed_user in removed_users)
+            if self.debounce is not None:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = threading.Timer(self.debounce, self._flush_in_background)
+                self._timer.start()
+
+    def flush(self):
+        """
+        :return: The number of digest emails sent
+
+        Sends every pending digest over one mail connection and empties the queue
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, OrderedDict()
+
+        messages = [self._digest_message(key, changes_by_group) for key, changes_by_group in pending.items()]
+        if messages:
+            connection = self.connection or get_connection(fail_silently=self.fail_silently)
+            connection.send_messages(messages)
+        return len(messages)
+
+    def _flush_in_background(self):
+        """
+        Flushes the queue from the debounce thread, where an error would otherwise only reach stderr
+        """
+        try:
+            self.flush()
+        except Exception:
+            logger.exception(u"Sending the queued group change notifications failed")
+
+    @staticmethod
+    def _digest_message(key, changes_by_group):
+        """
+        :param key: A tuple of the sender, recipients, portal name, portal link and custom message of the digest
+        :param changes_by_group: A dictionary of group name to the users added and removed from the group
+        :return: An html EmailMessage listing the changes of every group
+        """
+        from_email_address, to_email_addresses, portal_name, portal_link, custom_message = key
+        if len(changes_by_group) > 1:
+            # Pluralize group
+            group = 'Groups'
+        else:
+            group = 'Group'
+
+        changes = u''
+        for groupname, (new_users, removed_users) in changes_by_group.items():
+            if new_users:
+                changes += u'New {PUSER} <b>{USERNAMES}</b> assigned to Group {GROUPNAME}.' \
+                           u'<br /><br />'.format(PUSER='Users' if len(new_users) > 1 else 'User',
+                                                  USERNAMES=u', '.join(new_users),
+                                                  GROUPNAME=groupname)
+            if removed_users:
+                changes += u'{PUSER} <b>{USERNAMES}</b> removed from Group {GROUPNAME}.' \
+                           u'<br /><br />'.format(PUSER='Users' if len(removed_users) > 1 else 'User',
+                                                  USERNAMES=u', '.join(removed_users),
+                                                  GROUPNAME=groupname)
+
+        subject = u'{PORTAL_TITLE}: Membership Changed in {COUNT} {PGROUP}'.format(PORTAL_TITLE=portal_name,
+                                                                                COUNT=len(changes_by_group),
+                                                                                PGROUP=group)
+        html_content = u'<h2>{PORTAL_TITLE}</h2>' \
+                       u'<p>' \
+                       u'{CHANGES}' \
+                       u'{CUSTOM_MESSAGE}' \
+                       u'<br /><br />' \
+                       u'<a href="{LINK}">{LINK}</a>' \
+                       u'<br /><br />' \
+                       u'</p>'.format(PORTAL_TITLE=portal_name,
+                                      CHANGES=changes,
+                                      CUSTOM_MESSAGE=custom_message,
+                                      LINK=portal_link)
+        msg = EmailMessage(subject, html_content, from_email_address, list(to_email_addresses))
+        msg.content_subtype = "html"  # Main content is now text/html
+        return msg
@@ -0,0 +1,49 @@
+import json
+from django.db import models
+
+
+class LDAPGroupSyncState(models.Model):
+    """
+    Stores the high-water mark of the last incremental mirror of an LDAP group
+
+    highest_committed_usns is a JSON dictionary of server uri to the highestCommittedUSN and dsServiceName of the
+    domain controller read at the start of the run
+    usernames_by_dn is a JSON dictionary of member DN to username, null for members that could not be resolved
+    """
+    group_name = models.CharField(max_length=80, unique=True)
+    ldap_uri = models.CharField(max_length=255)
+    highest_committed_usns = models.TextField(default=u'{}')
+    usernames_by_dn = models.TextField(default=u'{}')
+    last_sync = models.DateTimeField()
+    last_full_sync = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.group_name
+
+    def get_highest_committed_usns(self):
+        return json.loads(self.highest_committed_usns)
+
+    def set_highest_committed_usns(self, value):
+        self.highest_committed_usns = json.dumps(value)
+
+    def get_usernames_by_dn(self):
+        # python-ldap returns DNs as UTF-8 encoded byte strings
+        return dict((dn.encode('utf-8'), username) for dn, username in json.loads(self.usernames_by_dn).items())
+
+    def set_usernames_by_dn(self, value):
+        self.usernames_by_dn = json.dumps(value)
+
+
+class LDAPGroupSchedule(models.Model):
+    """
+    When the scheduler mirrors an LDAP group next, see scheduler.MirrorScheduler
+
+    unchanged_runs counts the successful runs in a row that changed no users, each one doubles the wait before the next run
+    """
+    group_name = models.CharField(max_length=80, unique=True)
+    unchanged_runs = models.IntegerField(default=0)
+    last_run = models.DateTimeField(null=True)
+    next_run = models.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return self.group_name
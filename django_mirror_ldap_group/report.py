@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter(list):
+    """
+    Stands in for connection.queries while a run counts its queries, each query the debug cursor logs is counted
+    and dropped so a long run does not keep the SQL of every query
+    """
+    def __init__(self):
+        super(QueryCounter, self).__init__()
+        self.counted = 0
+
+    def append(self, query):
+        self.counted += 1
+
+    @staticmethod
+    def logged(queries):
+        """
+        :param queries: connection.queries, a list or a QueryCounter
+        :return: The number of queries logged in it
+        """
+        return queries.counted if isinstance(queries, QueryCounter) else len(queries)
+
+
+class MirrorReport(object):
+    """
+    The wall time of each phase and the counters of one mirror run
+
+    Phases:
+    total, ldap_bind, ldap_group_search, ldap_member_lookup, db_write, notify
+    A phase that needs a new LDAP connection includes the ldap_bind time of that connection
+
+    Counters:
+    ldap_binds, ldap_searches, ldap_referral_fallbacks, user_cache_hits, user_cache_misses, shared_member_hits,
+    db_queries, users_created, users_updated, users_added, users_removed
+
+    Counters can be incremented from many threads at once
+    """
+    def __init__(self, name):
+        """
+        :param name: The name of the group or run the report is for
+        :return: Nothing
+        """
+        self.name = name
+        self.status = None
+        self.message = None
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._active_phases = threading.local()
+
+    def incr(self, counter, count=1):
+        """
+        :param counter: The name of the counter
+        :param count: The amount to add to the counter
+        :return: Nothing
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + count
+
+    def add_time(self, phase, seconds):
+        """
+        :param phase: The name of the phase
+        :param seconds: The seconds to add to the wall time of the phase
+        :return: Nothing
+        """
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        """
+        :param phase: The name of the phase
+        :return: A context manager that adds the time spent inside it to the phase
+
+        Time spent in the same phase nested inside it on the same thread is only counted once
+        """
+        if not hasattr(self._active_phases, 'phases'):
+            self._active_phases.phases = set()
+        active_phases = self._active_phases.phases
+        if phase in active_phases:
+            yield
+            return
+
+        active_phases.add(phase)
+        started = time.time()
+        try:
+            yield
+        finally:
+            active_phases.discard(phase)
+            self.add_time(phase, time.time() - started)
+
+    @contextmanager
+    def run(self):
+        """
+        :return: A context manager timing the total phase and counting the database queries made inside it
+
+        When Django keeps the queries, with DEBUG on or inside assertNumQueries, they are counted from
+        connection.queries. Otherwise connection.queries is swapped for a QueryCounter for the run, so the queries
+        are counted without keeping their SQL
+        """
+        with self.phase('total'):
+            keep_queries = connection.use_debug_cursor or (connection.use_debug_cursor is None and settings.DEBUG)
+            use_debug_cursor = connection.use_debug_cursor
+            queries = connection.queries
+            connection.use_debug_cursor = True
+            if not keep_queries:
+                connection.queries = QueryCounter()
+            queries_start = QueryCounter.logged(connection.queries)
+            try:
+                yield
+            finally:
+                connection.use_debug_cursor = use_debug_cursor
+                self.incr('db_queries', max(0, QueryCounter.logged(connection.queries) - queries_start))
+                if not keep_queries:
+                    connection.queries = queries
+
+    def as_dict(self):
+        """
+        :return: A JSON serializable dictionary of the report
+        """
+        with self._lock:
+            return {'name': self.name,
+                    'status': self.status,
+                    'message': self.message,
+                    'phases': dict(self.phases),
+                    'counters': dict(self.counters)}
+
+    def finish(self, status, message, hooks=()):
+        """
+        :param status: True or False
+        :param message: The message returned by the run
+        :param hooks: A list of callables that are each called with the report
+        :return: Nothing
+
+        A hook that raises is logged and does not stop the other hooks or fail the run
+        """
+        self.status = status
+        self.message = message
+        for hook in hooks:
+            try:
+                hook(self)
+            except Exception:
+                logger.exception(u"Mirror report hook %r failed", hook)
+
+
+class LoggingReportHook(object):
+    """
+    Logs each report as one line with its phases and counters
+    """
+    def __init__(self, logger=logger, level=logging.INFO):
+        """
+        :param logger: The logger to log the reports to. Defaults to the django_mirror_ldap_group.report logger.
+        :param level: The logging level of the report line.
+        :return: Nothing
+        """
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, report):
+        self.logger.log(self.level, u"%s mirror %s phases=%s counters=%s", report.name,
+                        u"succeeded" if report.status else u"failed",
+                        u" ".join(u"{0}={1:.3f}".format(phase, seconds) for phase, seconds in sorted(report.phases.items())),
+                        u" ".join(u"{0}={1}".format(counter, count) for counter, count in sorted(report.counters.items())))
+
+
+class StatsdReportHook(object):
+    """
+    Emits each report to a statsd style client, any object with timing(stat, milliseconds) and incr(stat, count)
+
+    Phases are emitted as timings '<prefix>.<phase>' and counters as '<prefix>.<counter>'
+    Adapt a Prometheus client by passing an object with the same two methods
+    """
+    def __init__(self, client, prefix='django_mirror_ldap_group'):
+        """
+        :param client: The statsd style client. Example: statsd.StatsClient()
+        :param prefix: The prefix of every stat name.
+        :return: Nothing
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def __call__(self, report):
+        for phase, seconds in report.phases.items():
+            self.client.timing('{0}.{1}'.format(self.prefix, phase), seconds * 1000)
+        for counter, count in report.counters.items():
+            self.client.incr('{0}.{1}'.format(self.prefix, counter), count)
+        self.client.incr('{0}.{1}'.format(self.prefix, 'runs_succeeded' if report.status else 'runs_failed'))
@@ -0,0 +1,172 @@
+import fcntl
+import logging
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from django.db import connection
+from django.utils import timezone
+from django_mirror_ldap_group.mirror_ldap_group import MirrorLDAPGroup
+from django_mirror_ldap_group.models import LDAPGroupSchedule
+
+
+logger = logging.getLogger(__name__)
+
+
+# Counters of a MirrorReport that show the run changed the Django group
+CHANGE_COUNTERS = ['users_created', 'users_updated', 'users_added', 'users_removed']
+
+
+class MirrorScheduler():
+    """
+    Mirrors a list of LDAP groups, a few at a time, never running the same group twice at once
+
+    Each group is mirrored under a file lock so overlapping runs, from cron, Celery or the mirror_ldap_groups
+    management command, skip a group that is still being mirrored instead of repeating its work
+    Groups whose last run changed no users wait backoff seconds before they are mirrored again, doubling with each
+    unchanged run up to max_backoff, so the load follows how much the directory changes. The schedule is kept in the
+    LDAPGroupSchedule model
+
+    Call the function 'run' to mirror the groups that are due it will return the group name, status and a message
+    of every group. The notification_queue of options and of each group is flushed at the end of the run
+    """
+    def __init__(self, ldap_groups, options=None, max_workers=1, lock_dir=None, backoff=300, max_backoff=3600):
+        """
+        :param ldap_groups: A list of dictionaries of MirrorLDAPGroup init parameters for each group, at least ldap_group_name. Example: [{'ldap_group_name': 'IDBD_SCE_Approvers'},].
+        :param options: Optional. A dictionary of the MirrorLDAPGroup init parameters shared by every group.
+        :param max_workers: The number of groups mirrored at once.
+        :param lock_dir: Optional. The directory of the group lock files, shared by every process mirroring the groups. Defaults to the temporary directory.
+        :param backoff: Seconds to wait before mirroring a group again after a run that changed nothing or failed. 0 mirrors every group on every run.
+        :param max_backoff: The longest wait in seconds between runs of an unchanged group.
+        :return: Nothing
+        """
+        if not isinstance(ldap_groups, (tuple, list)) \
+                or not all(isinstance(ldap_group, dict) and ldap_group.get('ldap_group_name') for ldap_group in ldap_groups):
+            raise ValueError(u"Must enter ldap_groups as a list of dictionaries with an ldap_group_name! "
+                             u"Example: [{'ldap_group_name': 'IDBD_SCE_Approvers'},]")
+        if not isinstance(max_workers, int) or max_workers < 1:
+            raise ValueError(u"The max workers must be a positive integer!")
+        self.ldap_groups = ldap_groups
+        self.options = options or {}
+        self.max_workers = max_workers
+        self.lock_dir = lock_dir or tempfile.gettempdir()
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def run(self, group_names=None, force=False):
+        """
+        :param group_names: Optional. A list of the names of the groups to mirror. By default every group is mirrored.
+        :param force: True or False mirror the groups even if they are backing off.
+        :return: A list with a tuple with the group name, status of True, False or None if the group was skipped, and a message
+        """
+        ldap_groups = [ldap_group for ldap_group in self.ldap_groups
+                       if group_names is None or ldap_group.get('ldap_group_name') in group_names]
+        if not ldap_groups:
+            return []
+
+        thread_pool = ThreadPool(min(self.max_workers, len(ldap_groups)))
+        try:
+            return thread_pool.map(lambda ldap_group: self._run_group(ldap_group, force), ldap_groups)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+            self._flush_notifications(ldap_groups)
+
+    def _flush_notifications(self, ldap_groups):
+        """
+        :param ldap_groups: A list of dictionaries of MirrorLDAPGroup init parameters of the groups that were run
+        :return: Nothing
+
+        Sends the digests queued by the run, a queue without a debounce would otherwise only be sent by its owner
+        A queue that fails to send is logged and does not fail the groups, their Django groups are already mirrored
+        """
+        notification_queues = []
+        for ldap_group in [self.options] + ldap_groups:
+            notification_queue = ldap_group.get('notification_queue')
+            if notification_queue is not None and notification_queue not in notification_queues:
+                notification_queues.append(notification_queue)
+        for notification_queue in notification_queues:
+            try:
+                notification_queue.flush()
+            except Exception:
+                logger.exception(u"Sending the group change notifications failed")
+
+    def _run_group(self, ldap_group, force):
+        """
+        :param ldap_group: A dictionary of MirrorLDAPGroup init parameters of the group
+        :param force: True or False mirror the group even if it is backing off
+        :return: A tuple with the group name, status of True, False or None if the group was skipped, and a message
+
+        An exception raised while mirroring the group is logged and fails only that group
+        """
+        group_name = ldap_group.get('ldap_group_name')
+        try:
+            with self._lock(group_name) as locked:
+                if not locked:
+                    return group_name, None, u"{GROUP_NAME} Skipped! Already being mirrored.".format(GROUP_NAME=group_name)
+
+                schedule, created = LDAPGroupSchedule.objects.get_or_create(group_name=group_name)
+                if not force and schedule.next_run and schedule.next_run > timezone.now():
+                    return group_name, None, u"{GROUP_NAME} Skipped! Backing off until {NEXT_RUN}.".format(
+                        GROUP_NAME=group_name, NEXT_RUN=schedule.next_run.isoformat())
+
+                try:
+                    mirror = MirrorLDAPGroup(**dict(self.options, **ldap_group))
+                    status, message = mirror.mirror_ldap_group()
+                except Exception, error:
+                    logger.exception(u"Mirroring %s raised an exception", group_name)
+                    try:
+                        self._schedule(schedule, False, None)
+                    except Exception:
+                        logger.exception(u"Scheduling %s after a failed run raised an exception", group_name)
+                    return group_name, False, u"{GROUP_NAME} Mirroring Failed! {ERROR_MESSAGE}".format(
+                        GROUP_NAME=group_name, ERROR_MESSAGE=error)
+                self._schedule(schedule, status, mirror.report)
+                return group_name, status, message
+        finally:
+            connection.close()  # Each worker thread has its own database connection
+
+    def _schedule(self, schedule, status, report):
+        """
+        :param schedule: The LDAPGroupSchedule of the group
+        :param status: True or False the run succeeded
+        :param report: The MirrorReport of the run, None if the run raised
+        :return: Nothing
+
+        A run that changed users resets the backoff, the group is mirrored again on the next run
+        """
+        now = timezone.now()
+        if status and any(report.counters.get(counter) for counter in CHANGE_COUNTERS):
+            schedule.unchanged_runs = 0
+            wait = 0
+        elif status:
+            schedule.unchanged_runs += 1
+            wait = min(self.max_backoff, self.backoff * 2 ** (schedule.unchanged_runs - 1))
+        else:
+            wait = self.backoff  # Failed groups are retried after the backoff instead of on every run
+        schedule.last_run = now
+        schedule.next_run = now + timedelta(seconds=wait)
+        schedule.save()
+
+    @contextmanager
+    def _lock(self, group_name):
+        """
+        :param group_name: The name of the group
+        :return: A context manager giving True if the lock of the group was taken or False if another run holds it
+
+        The lock is an flock on a file in lock_dir, it is released when the run ends or its process dies
+        """
+        lock_path = os.path.join(self.lock_dir, u"django_mirror_ldap_group.{0}.lock".format(
+            re.sub(r'[^\w.-]', '_', group_name)))
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
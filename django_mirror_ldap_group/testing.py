@@ -0,0 +1,290 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+
+class FakeDirectory(object):
+    """
+    An in-process Active Directory forest of one or more domains, served by FakeLDAPConnection
+
+    Each domain is reached on its own uri 'ldap://<first DC value>.bench' and only answers for its own naming context,
+    searches for other naming contexts raise ldap.REFERRAL the same as a domain controller with referrals turned off
+    add_domain_controller gives a domain another uri, the same as a second domain controller
+    Every round trip to a server sleeps for latency seconds, searches sent with search_ext overlap their latency
+    domain_controllers names the domain controller each domain's uri resolves to, change it to simulate a failover
+    search_errors is a list of (naming context, filter regex, ldap.LDAPError) the domain raises for matching searches
+    """
+    max_val_range = 1500  # Active Directory MaxValRange
+    max_page_size = 1000  # Active Directory MaxPageSize
+
+    def __init__(self, naming_contexts, latency=0.0):
+        """
+        :param naming_contexts: A list of the naming contexts of the domains. Example: ['DC=d0,DC=bench']
+        :param latency: Seconds each round trip to a server takes
+        :return: Nothing
+        """
+        self.latency = latency
+        self.naming_contexts = list(naming_contexts)
+        self.entries = dict((naming_context.lower(), {}) for naming_context in self.naming_contexts)
+        self.highest_committed_usn = 1
+        self.domain_controllers = dict((naming_context.lower(), 'DC1') for naming_context in self.naming_contexts)
+        self.search_errors = []
+        self.domain_controller_uris = {}  # uri = naming context, see add_domain_controller
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def synthetic(cls, members, domains=3, latency=0.0, group_name='Bench'):
+        """
+        :param members: The number of members of the group
+        :param domains: The number of domains the members are spread across, the group is in the first one
+        :param latency: Seconds each round trip to a server takes
+        :param group_name: The CN of the group
+        :return: A FakeDirectory with the group CN=<group_name>,OU=Groups,<first naming context>
+        """
+        directory = cls(['DC=d{0},DC=bench'.format(index) for index in range(domains)], latency=latency)
+        member_dns = [directory.add_user(index) for index in range(members)]
+        directory.add_group('CN={0},OU=Groups,{1}'.format(group_name, directory.naming_contexts[0]), member_dns)
+        return directory
+
+    def uri(self, naming_context):
+        return 'ldap://{0}.bench'.format(naming_context.split(',')[0].split('=', 1)[1])
+
+    def add_domain_controller(self, naming_context, name):
+        """
+        :param naming_context: The naming context of the domain
+        :param name: The host name of the domain controller. Example: 'dc2'
+        :return: Another uri reaching the domain, 'ldap://<name>.<first DC value>.bench'
+        """
+        uri = 'ldap://{0}.{1}'.format(name, self.uri(naming_context)[len('ldap://'):])
+        self.domain_controller_uris[uri] = naming_context
+        return uri
+
+    def naming_context_of_uri(self, uri):
+        """
+        :return: The naming context of the domain reached on the uri or None if no domain is
+        """
+        for naming_context in self.naming_contexts:
+            if self.uri(naming_context) == uri:
+                return naming_context
+        return self.domain_controller_uris.get(uri)
+
+    def servers(self):
+        """
+        :return: A list of connection dictionaries for every domain, first domain first
+        """
+        return [{'uri': self.uri(naming_context), 'username': 'CN=bench', 'password': 'bench'}
+                for naming_context in self.naming_contexts]
+
+    def add_user(self, index):
+        """
+        :param index: The number of the user, users are spread round robin across the domains
+        :return: The DN of the user
+        """
+        naming_context = self.naming_contexts[index % len(self.naming_contexts)]
+        dn = 'CN=user{0},OU=Users,{1}'.format(index, naming_context)
+        self._set(naming_context, dn, {'objectClass': ['top', 'person', 'user'],
+                                       'sAMAccountName': ['USER{0}'.format(index)],
+                                       'givenName': ['First{0}'.format(index)],
+                                       'sn': ['Last{0}'.format(index)],
+                                       'mail': ['user{0}@bench.example'.format(index)]})
+        return dn
+
+    def add_group(self, dn, member_dns):
+        self._set(self._naming_context_of(dn), dn, {'objectClass': ['top', 'group'], 'member': list(member_dns)})
+
+    def update(self, dn, **attributes):
+        """
+        Replaces attributes of an entry and moves its uSNChanged past every earlier change, attributes set to None
+        are removed
+        """
+        naming_context = self._naming_context_of(dn)
+        entry = dict(self.entries[naming_context.lower()][dn.lower()][1])
+        entry.update(attributes)
+        for attribute, value in attributes.items():
+            if value is None:
+                del entry[attribute]
+        self._set(naming_context, dn, entry)
+
+    def entry(self, dn):
+        return self.entries[self._naming_context_of(dn).lower()][dn.lower()][1]
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def count_max(self, counter, value):
+        with self._lock:
+            self.counters[counter] = max(self.counters.get(counter, 0), value)
+
+    def reset_counters(self):
+        with self._lock:
+            self.counters = {}
+
+    def _set(self, naming_context, dn, attributes):
+        with self._lock:
+            self.highest_committed_usn += 1
+            attributes['uSNChanged'] = [str(self.highest_committed_usn)]
+            self.entries[naming_context.lower()][dn.lower()] = (dn, attributes)
+
+    def _naming_context_of(self, dn):
+        for naming_context in self.naming_contexts:
+            if dn.lower().endswith(naming_context.lower()):
+                return naming_context
+        raise ValueError(u"No domain holds {0}".format(dn))
+
+
+class FakeLDAPConnection(object):
+    """
+    Stands in for the object returned by ldap.initialize, implementing the calls LDAPAPI makes
+
+    Understands the filters LDAPAPI sends: (objectClass=*), OR lists of (distinguishedName=...), the same lists
+    and-ed with (objectClass=group) and (&(objectClass=user)(uSNChanged>=N))
+    """
+    def __init__(self, directory, naming_context):
+        self.directory = directory
+        self.naming_context = naming_context
+        self._pending = {}
+        self._msgid = 0
+
+    def set_option(self, option, value):
+        pass
+
+    def start_tls_s(self):
+        self._round_trip()
+
+    def bind_s(self, who, cred):
+        self.directory.count('binds')
+        self._round_trip()
+
+    def whoami_s(self):
+        self._round_trip()
+        return 'u:bench'
+
+    def unbind(self):
+        pass
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None):
+        self.directory.count('searches')
+        self._round_trip()
+        return self._search(base, scope, filterstr, attrlist)
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, serverctrls=None):
+        self.directory.count('searches')
+        self.directory.count('round_trips')
+        self._msgid += 1
+        try:
+            results = self._search(base, scope, filterstr, attrlist)
+        except ldap.LDAPError, error:
+            results = error
+
+        page_controls = [control for control in serverctrls or ()
+                         if control.controlType == SimplePagedResultsControl.controlType]
+        cookie = ''
+        if page_controls and not isinstance(results, ldap.LDAPError):
+            start = int(page_controls[0].cookie or 0)
+            end = start + min(page_controls[0].size or self.directory.max_page_size, self.directory.max_page_size)
+            results, cookie = results[start:end], str(end) if end < len(results) else ''
+        self._pending[self._msgid] = (time.time() + self.directory.latency, results, cookie)
+        self.directory.count_max('max_in_flight', len(self._pending))
+        return self._msgid
+
+    def result3(self, msgid):
+        ready, results, cookie = self._pending.pop(msgid)
+        time.sleep(max(0.0, ready - time.time()))
+        if isinstance(results, ldap.LDAPError):
+            raise results
+        return ldap.RES_SEARCH_RESULT, results, msgid, [SimplePagedResultsControl(True, size=0, cookie=cookie)]
+
+    def _round_trip(self):
+        self.directory.count('round_trips')
+        if self.directory.latency:
+            time.sleep(self.directory.latency)
+
+    def _search(self, base, scope, filterstr, attrlist):
+        if base == '':
+            return [('', {'defaultNamingContext': [self.naming_context],
+                          'highestCommittedUSN': [str(self.directory.highest_committed_usn)],
+                          'dsServiceName': ['CN=NTDS Settings,CN={0},CN=Servers,CN=Bench,CN=Sites,'
+                                            'CN=Configuration,{1}'.format(
+                                                self.directory.domain_controllers[self.naming_context.lower()],
+                                                self.naming_context)]})]
+        if not base.lower().endswith(self.naming_context.lower()):
+            raise ldap.REFERRAL({'desc': 'Referral', 'info': base})
+        for naming_context, pattern, error in self.directory.search_errors:
+            if naming_context.lower() == self.naming_context.lower() and re.search(pattern, filterstr):
+                raise error
+
+        entries = self.directory.entries[self.naming_context.lower()]
+        if scope == ldap.SCOPE_BASE:
+            if base.lower() not in entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': 'No such object', 'matched': self.naming_context})
+            candidates = [entries[base.lower()]]
+        else:
+            dns = [self._unescape(dn) for dn in re.findall(r'\(distinguishedName=([^)]*)\)', filterstr)]
+            if dns:
+                candidates = [entries[dn.lower()] for dn in dns if dn.lower() in entries]
+            else:
+                candidates = entries.values()
+            candidates = [(dn, attributes) for dn, attributes in candidates if dn.lower().endswith(base.lower())]
+
+        object_class = re.search(r'\(objectClass=(\w+)\)', filterstr)
+        if object_class:
+            candidates = [(dn, attributes) for dn, attributes in candidates
+                          if object_class.group(1) in attributes.get('objectClass', ())]
+        usn_changed = re.search(r'\(uSNChanged>=(\d+)\)', filterstr)
+        if usn_changed:
+            candidates = [(dn, attributes) for dn, attributes in candidates
+                          if int(attributes['uSNChanged'][0]) >= int(usn_changed.group(1))]
+
+        return [(dn, self._attributes(attributes, attrlist)) for dn, attributes in candidates]
+
+    def _attributes(self, attributes, attrlist):
+        if not attrlist:
+            return dict(attributes)
+        if attrlist == ['1.1']:
+            return {}
+        result = {}
+        for attribute in attrlist:
+            member_range = re.match(r'member;range=(\d+)-(\d+|\*)$', attribute)
+            if member_range:
+                members = attributes.get('member', [])
+                low = int(member_range.group(1))
+                if low >= len(members):
+                    continue
+                high = len(members) - 1 if member_range.group(2) == '*' else int(member_range.group(2))
+                high = min(high, low + self.directory.max_val_range - 1, len(members) - 1)
+                last = high == len(members) - 1
+                result['member;range={0}-{1}'.format(low, '*' if last else high)] = members[low:high + 1]
+            elif attribute in attributes:
+                result[attribute] = attributes[attribute]
+        return result
+
+    @staticmethod
+    def _unescape(value):
+        return re.sub(r'\\([0-9a-fA-F]{2})', lambda match: chr(int(match.group(1), 16)), value)
+
+
+@contextmanager
+def patch_initialize(directory):
+    """
+    :param directory: The FakeDirectory to connect to
+    :return: A context manager replacing ldap.initialize so every LDAPAPI connects to the directory
+    """
+    def initialize(uri):
+        directory.count('connects')
+        naming_context = directory.naming_context_of_uri(uri)
+        if naming_context is None:
+            directory.count('unreachable_connects')
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server", 'info': uri})
+        return FakeLDAPConnection(directory, naming_context)
+
+    original_initialize = ldap.initialize
+    ldap.initialize = initialize
+    try:
+        yield directory
+    finally:
+        ldap.initialize = original_initialize
@@ -0,0 +1,580 @@
+import json
+import ldap
+import logging
+import shutil
+import tempfile
+from django.contrib.auth.models import User, Group
+from django.core import mail
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+from django_mirror_ldap_group.ldapapi import DjangoUserCache, DomainRouter, LDAPAPI, LocMemUserCache
+from django_mirror_ldap_group.mirror_ldap_group import MirrorLDAPGroup, MirrorLDAPGroups, NotificationQueue
+from django_mirror_ldap_group.models import LDAPGroupSchedule, LDAPGroupSyncState
+from django_mirror_ldap_group.report import LoggingReportHook, StatsdReportHook
+from django_mirror_ldap_group.scheduler import MirrorScheduler
+from django_mirror_ldap_group.testing import FakeDirectory, patch_initialize
+
+
+class ListHandler(logging.Handler):
+    """
+    Keeps the log records it is given
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class FakeDirectoryTestCase(TestCase):
+    """
+    Mirrors groups from an in-process django_mirror_ldap_group.testing.FakeDirectory, no LDAP server is needed
+
+    Run with: django-admin.py test django_mirror_ldap_group --settings=benchmarks.settings
+    """
+    def setUp(self):
+        self.directory = FakeDirectory.synthetic(members=20, domains=2)
+        self.group_dn = 'CN=Bench,OU=Groups,{0}'.format(self.directory.naming_contexts[0])
+        patcher = patch_initialize(self.directory)
+        patcher.__enter__()
+        self.addCleanup(patcher.__exit__, None, None, None)
+
+    def mirror(self, ldap_group_name='Bench', ldap_referrals=None, **options):
+        """
+        :return: The MirrorLDAPGroup and the status and message of its run
+        """
+        mirror_ldap_group = self.mirror_ldap_group(ldap_group_name, ldap_referrals, **options)
+        status, message = mirror_ldap_group.mirror_ldap_group()
+        return mirror_ldap_group, status, message
+
+    def mirror_ldap_group(self, ldap_group_name='Bench', ldap_referrals=None, **options):
+        return MirrorLDAPGroup(**dict(self.ldap_group(ldap_group_name), **dict(self.ldap_options(ldap_referrals),
+                                                                               **options)))
+
+    def ldap_group(self, ldap_group_name='Bench'):
+        """
+        :return: A dictionary of the MirrorLDAPGroup init parameters of a group in the first domain
+        """
+        return {'ldap_group_name': ldap_group_name,
+                'ldap_group_base_dn': 'OU=Groups,{0}'.format(self.directory.naming_contexts[0])}
+
+    def ldap_options(self, ldap_referrals=None):
+        """
+        :return: A dictionary of the MirrorLDAPGroup init parameters connecting to the directory
+        """
+        servers = self.directory.servers()
+        return {'ldap_uri': servers[0]['uri'],
+                'ldap_username': servers[0]['username'],
+                'ldap_password': servers[0]['password'],
+                'ldap_referrals': servers[1:] if ldap_referrals is None else ldap_referrals}
+
+    def ldapapi(self, ldap_referrals=None, **options):
+        ldap_options = self.ldap_options(ldap_referrals)
+        return LDAPAPI(ldap_uri=ldap_options['ldap_uri'], ldap_username=ldap_options['ldap_username'],
+                       ldap_password=ldap_options['ldap_password'], ldap_referrals=ldap_options['ldap_referrals'],
+                       **options)
+
+    def group_usernames(self, group_name='Bench'):
+        return set(Group.objects.get(name=group_name).user_set.values_list('username', flat=True))
+
+
+class MirrorLDAPGroupTestCase(FakeDirectoryTestCase):
+    def test_mirror(self):
+        mirror_ldap_group, status, message = self.mirror()
+        self.assertTrue(status, message)
+        self.assertEqual(self.group_usernames(), set(u'user{0}'.format(index) for index in range(20)))
+        self.assertEqual(mirror_ldap_group.report.counters['users_created'], 20)
+
+        mirror_ldap_group, status, message = self.mirror()
+        self.assertTrue(status, message)
+        self.assertFalse(mirror_ldap_group.report.counters.get('users_created'))
+        self.assertFalse(mirror_ldap_group.report.counters.get('users_updated'))
+
+    def test_ranged_member_retrieval(self):
+        self.directory.max_val_range = 6  # The 20 members are read in four ranges
+        mirror_ldap_group, status, message = self.mirror()
+        self.assertTrue(status, message)
+        self.assertEqual(len(self.group_usernames()), 20)
+
+    def test_nested_group_cycle(self):
+        naming_context = self.directory.naming_contexts[0]
+        outer_dn = 'CN=Outer,OU=Groups,{0}'.format(naming_context)
+        inner_dn = 'CN=Inner,OU=Groups,{0}'.format(naming_context)
+        self.directory.add_group(outer_dn, [self.directory.add_user(100), inner_dn])
+        self.directory.add_group(inner_dn, [self.directory.add_user(101), outer_dn])
+
+        mirror_ldap_group, status, message = self.mirror(ldap_group_name='Outer', ldap_nested_groups=True)
+        self.assertTrue(status, message)
+        self.assertEqual(self.group_usernames('Outer'), set([u'user100', u'user101']))
+
+    def test_nested_group_lookup_error(self):
+        outer_dn = 'CN=Outer,OU=Groups,{0}'.format(self.directory.naming_contexts[0])
+        inner_dn = 'CN=Inner,OU=Groups,{0}'.format(self.directory.naming_contexts[1])
+        self.directory.add_group(inner_dn, [self.directory.add_user(301), self.directory.add_user(303)])
+        self.directory.add_group(outer_dn, [self.directory.add_user(300), inner_dn])
+        mirror_ldap_group, status, message = self.mirror(ldap_group_name='Outer', ldap_nested_groups=True)
+        self.assertTrue(status, message)
+        self.assertEqual(self.group_usernames('Outer'), set([u'user300', u'user301', u'user303']))
+
+        # The inner group can not be told apart from a user, its members must not be removed
+        self.directory.search_errors.append((self.directory.naming_contexts[1], r'objectClass=group',
+                                             ldap.TIMELIMIT_EXCEEDED({'desc': 'Time limit exceeded'})))
+        mirror_ldap_group, status, message = self.mirror(ldap_group_name='Outer', ldap_nested_groups=True)
+        self.assertFalse(status, message)
+        self.assertEqual(self.group_usernames('Outer'), set([u'user300', u'user301', u'user303']))
+
+    def test_incremental_deltas(self):
+        mirror_ldap_group, status, message = self.mirror(incremental=True)
+        self.assertTrue(status, message)
+
+        member_dns = list(self.directory.entry(self.group_dn)['member'])
+        self.directory.update(member_dns[1], mail=['renamed@bench.example'])
+        self.directory.update(member_dns[2], mail=None)  # user2 can no longer be resolved
+        unresolved_dn = self.directory.add_user(101)
+        self.directory.update(unresolved_dn, mail=None)
+        self.directory.update(self.group_dn, member=member_dns[1:] + [self.directory.add_user(100), unresolved_dn])
+        mirror_ldap_group, status, message = self.mirror(incremental=True)
+        self.assertTrue(status, message)
+        counters = mirror_ldap_group.report.counters
+        self.assertEqual((counters.get('users_created'), counters.get('users_updated'), counters.get('users_removed')),
+                         (1, 1, 2))
+        self.assertEqual(User.objects.get(username=u'user1').email, u'renamed@bench.example')
+        self.assertNotIn(u'user0', self.group_usernames())
+        self.assertNotIn(u'user2', self.group_usernames())
+        self.assertNotIn(u'user101', self.group_usernames())
+        self.assertIn(u'user100', self.group_usernames())
+
+        # The unresolved member is picked up once it changes, without a change to the group
+        self.directory.update(unresolved_dn, mail=['user101@bench.example'])
+        mirror_ldap_group, status, message = self.mirror(incremental=True)
+        self.assertTrue(status, message)
+        self.assertEqual(mirror_ldap_group.report.counters.get('users_created'), 1)
+        self.assertIn(u'user101', self.group_usernames())
+        self.assertNotIn(u'user2', self.group_usernames())
+
+    def test_incremental_domain_controller_change(self):
+        mirror_ldap_group, status, message = self.mirror(incremental=True)
+        self.assertTrue(status, message)
+        last_full_sync = LDAPGroupSyncState.objects.get(group_name='Bench').last_full_sync
+
+        self.mirror(incremental=True)
+        self.assertEqual(LDAPGroupSyncState.objects.get(group_name='Bench').last_full_sync, last_full_sync)
+
+        # USNs of another domain controller can not be compared, so a full mirror runs
+        self.directory.domain_controllers[self.directory.naming_contexts[1].lower()] = 'DC2'
+        mirror_ldap_group, status, message = self.mirror(incremental=True)
+        self.assertTrue(status, message)
+        self.assertGreater(LDAPGroupSyncState.objects.get(group_name='Bench').last_full_sync, last_full_sync)
+
+    def test_plan_and_apply(self):
+        mirror_ldap_group = self.mirror_ldap_group()
+        status, plan = mirror_ldap_group.plan_ldap_group()
+        self.assertTrue(status, plan)
+        self.assertEqual(len(plan['create']), 20)
+        self.assertEqual(User.objects.count(), 0)
+
+        status, message = mirror_ldap_group.apply_plan(json.loads(json.dumps(plan)))
+        self.assertTrue(status, message)
+        self.assertEqual(len(self.group_usernames()), 20)
+
+        status, plan = mirror_ldap_group.plan_ldap_group()
+        self.assertTrue(status, plan)
+        self.assertEqual((plan['create'], plan['update'], plan['add'], plan['remove']), ([], [], [], []))
+
+    def test_non_ascii_attributes(self):
+        member_dns = list(self.directory.entry(self.group_dn)['member'])
+        self.directory.update(member_dns[0], sAMAccountName=[u'J\xd6RG'.encode('utf-8')],
+                              givenName=[u'J\xf6rg'.encode('utf-8')])
+        for run in range(2):
+            mirror_ldap_group, status, message = self.mirror()
+            self.assertTrue(status, message)
+        self.assertFalse(mirror_ldap_group.report.counters.get('users_created'))
+        self.assertFalse(mirror_ldap_group.report.counters.get('users_updated'))
+        self.assertEqual(User.objects.get(username=u'j\xf6rg').first_name, u'J\xf6rg')
+
+    def test_domain_controller_outage(self):
+        mirror_ldap_group, status, message = self.mirror()
+        self.assertTrue(status, message)
+
+        # The members in the second domain can not be looked up, they must not be removed
+        down_servers = [dict(self.directory.servers()[1], uri='ldap://down.bench')]
+        for options in ({}, {'ldap_max_workers': 4, 'ldap_chunk_size': 5}, {'ldap_pipeline': True, 'ldap_chunk_size': 5}):
+            mirror_ldap_group, status, message = self.mirror(ldap_referrals=down_servers, **options)
+            self.assertFalse(status, message)
+            self.assertEqual(len(self.group_usernames()), 20)
+
+        # The rootDSE read and the first chunk connect to the down server, the second chunk is not searched
+        self.directory.reset_counters()
+        mirror_ldap_group, status, message = self.mirror(ldap_referrals=down_servers, ldap_chunk_size=5)
+        self.assertFalse(status, message)
+        self.assertEqual(self.directory.counters['unreachable_connects'], 2)
+
+    def test_unreachable_server(self):
+        with self.ldapapi() as ldapapi:
+            self.directory.reset_counters()
+            # Only a reused connection that was dropped is retried, a server that can not be reached is tried once
+            self.assertRaises(ldap.SERVER_DOWN, ldapapi._search, 'ldap://down.bench', 'CN=bench', 'bench', '',
+                              ldap.SCOPE_BASE)
+            self.assertEqual(self.directory.counters['connects'], 1)
+
+    def test_thread_pool(self):
+        member_dns = self.directory.entry(self.group_dn)['member']
+        with self.ldapapi(max_workers=4, chunk_size=5) as ldapapi:
+            status, users = ldapapi.get_users_attributes(member_dns)
+            self.assertTrue(status, users)
+            thread_pool = ldapapi._threads
+            status, users = ldapapi.get_users_attributes(member_dns)
+            self.assertTrue(status, users)
+            self.assertEqual(len(users), 20)
+            self.assertIs(ldapapi._threads, thread_pool)  # One pool for every page
+        self.assertIsNone(ldapapi._threads)
+
+    def test_pipeline_depth(self):
+        for options, max_in_flight in (({'ldap_max_connections_per_uri': 1}, 1), ({'ldap_pipeline_depth': 3}, 3)):
+            self.directory.reset_counters()
+            mirror_ldap_group, status, message = self.mirror(ldap_pipeline=True, ldap_chunk_size=1, **options)
+            self.assertTrue(status, message)
+            self.assertEqual(self.directory.counters['max_in_flight'], max_in_flight)
+
+
+class MirrorSchedulerTestCase(FakeDirectoryTestCase):
+    """
+    The groups are mirrored with _run_group on the test thread, the thread pool of run would open its own connection
+    to an empty in-memory database
+    """
+    def setUp(self):
+        super(MirrorSchedulerTestCase, self).setUp()
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+
+    def scheduler(self, ldap_groups=None, **options):
+        return MirrorScheduler(ldap_groups=ldap_groups or [self.ldap_group()], options=self.ldap_options(),
+                               lock_dir=self.lock_dir, **options)
+
+    def wait(self, group_name='Bench'):
+        """
+        :return: The seconds the schedule of the group waits after its last run
+        """
+        schedule = LDAPGroupSchedule.objects.get(group_name=group_name)
+        return (schedule.next_run - schedule.last_run).total_seconds()
+
+    def test_locked_group_skipped(self):
+        scheduler = self.scheduler()
+        with scheduler._lock('Bench') as locked:
+            self.assertTrue(locked)
+            group_name, status, message = scheduler._run_group(self.ldap_group(), force=False)
+        self.assertIsNone(status, message)
+        self.assertIn(u"Already being mirrored", message)
+        self.assertFalse(Group.objects.filter(name='Bench').exists())
+
+        group_name, status, message = scheduler._run_group(self.ldap_group(), force=False)
+        self.assertTrue(status, message)
+
+    def test_run_flushes_notifications(self):
+        notification_queue = NotificationQueue()
+        notification_queue.add(mirror=self.mirror_ldap_group(notify_new_user_added=True,
+                                                             notify_to_email_addresses=['admin@bench.example'],
+                                                             notify_from_email_address='mirror@bench.example'),
+                               new_users=[u'A (a)'])
+        scheduler = MirrorScheduler(ldap_groups=[self.ldap_group()],
+                                    options=dict(self.ldap_options(), notification_queue=notification_queue),
+                                    lock_dir=self.lock_dir)
+        # The locked group is skipped without a query so run's thread pool never opens its empty database
+        with scheduler._lock('Bench'):
+            results = scheduler.run()
+        self.assertEqual([status for group_name, status, message in results], [None])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(notification_queue.flush(), 0)
+
+    def test_backoff(self):
+        scheduler = self.scheduler(backoff=60, max_backoff=150)
+        for expected_wait in (0, 60):
+            group_name, status, message = scheduler._run_group(self.ldap_group(), force=False)
+            self.assertTrue(status, message)
+            self.assertEqual(self.wait(), expected_wait)  # The first run created the users
+
+        group_name, status, message = scheduler._run_group(self.ldap_group(), force=False)
+        self.assertIsNone(status, message)
+        self.assertIn(u"Backing off", message)
+
+        # Forced runs still double the wait, up to max_backoff
+        for expected_wait in (120, 150):
+            group_name, status, message = scheduler._run_group(self.ldap_group(), force=True)
+            self.assertTrue(status, message)
+            self.assertEqual(self.wait(), expected_wait)
+
+        # A run that changes users resets the backoff
+        self.directory.update(self.group_dn, member=self.directory.entry(self.group_dn)['member'][1:])
+        group_name, status, message = scheduler._run_group(self.ldap_group(), force=True)
+        self.assertTrue(status, message)
+        self.assertEqual(self.wait(), 0)
+        self.assertEqual(LDAPGroupSchedule.objects.get(group_name='Bench').unchanged_runs, 0)
+
+    def test_group_exception(self):
+        broken_group = {'ldap_group_name': 'Broken', 'ldap_group_base_dn': ''}  # MirrorLDAPGroup raises ValueError
+        scheduler = self.scheduler(ldap_groups=[broken_group, self.ldap_group()], backoff=60)
+        results = [scheduler._run_group(ldap_group, force=False) for ldap_group in scheduler.ldap_groups]
+
+        self.assertEqual([(group_name, status) for group_name, status, message in results],
+                         [('Broken', False), ('Bench', True)])
+        self.assertIn(u"Broken Mirroring Failed!", results[0][2])
+        self.assertEqual(self.wait('Broken'), 60)
+        self.assertEqual(len(self.group_usernames()), 20)
+
+    def test_command_unknown_groups(self):
+        with override_settings(MIRROR_LDAP_GROUPS=[dict(self.ldap_group(), **self.ldap_options())]):
+            self.assertRaisesRegexp(CommandError, u"Groups not in MIRROR_LDAP_GROUPS: Other, Unknown",
+                                    call_command, 'mirror_ldap_groups', 'Unknown', 'Bench', 'Other')
+        self.assertFalse(Group.objects.filter(name='Bench').exists())
+
+    def test_command_settings(self):
+        with override_settings(MIRROR_LDAP_GROUPS=[]):
+            self.assertRaisesRegexp(CommandError, u"Must set MIRROR_LDAP_GROUPS", call_command, 'mirror_ldap_groups')
+        with override_settings(MIRROR_LDAP_GROUPS=[self.ldap_options()]):
+            self.assertRaisesRegexp(CommandError, u"ldap_group_name", call_command, 'mirror_ldap_groups')
+
+
+class NotificationQueueTestCase(FakeDirectoryTestCase):
+    """
+    The test runner sends mail with the locmem backend, sent emails are in mail.outbox
+    """
+    def notifying_mirror(self, ldap_group_name='Bench', **options):
+        return self.mirror_ldap_group(ldap_group_name, **dict({'notify_new_user_added': True,
+                                                               'notify_to_email_addresses': ['admin@bench.example'],
+                                                               'notify_from_email_address': 'mirror@bench.example',
+                                                               'notify_portal_name': 'Bench Portal',
+                                                               'notify_portal_link': 'http://bench.example'},
+                                                              **options))
+
+    def test_digest(self):
+        self.directory.add_group('CN=Other,OU=Groups,{0}'.format(self.directory.naming_contexts[0]),
+                                 [self.directory.add_user(200), self.directory.add_user(201)])
+        notification_queue = NotificationQueue()
+        for ldap_group_name in ('Bench', 'Other'):
+            status, message = self.notifying_mirror(ldap_group_name,
+                                                    notification_queue=notification_queue).mirror_ldap_group()
+            self.assertTrue(status, message)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(notification_queue.flush(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, u'Bench Portal: Membership Changed in 2 Groups')
+        self.assertEqual(mail.outbox[0].to, ['admin@bench.example'])
+        self.assertIn(u'First0 Last0 (user0)', mail.outbox[0].body)
+        self.assertIn(u'First201 Last201 (user201)', mail.outbox[0].body)
+        self.assertIn(u'</b> assigned to Group Other', mail.outbox[0].body)
+        self.assertEqual(notification_queue.flush(), 0)
+
+    def test_merge(self):
+        notification_queue = NotificationQueue(notify_removed_users=True)
+        mirror = self.notifying_mirror()
+        notification_queue.add(mirror=mirror, new_users=[u'A (a)'], removed_users=[])
+        notification_queue.add(mirror=mirror, new_users=[u'A (a)', u'B (b)'], removed_users=[u'c'])
+        # Other recipients get a digest of their own
+        notification_queue.add(mirror=self.notifying_mirror(notify_to_email_addresses=['other@bench.example']),
+                               new_users=[u'D (d)'])
+
+        self.assertEqual(notification_queue.flush(), 2)
+        self.assertEqual([message.to for message in mail.outbox], [['admin@bench.example'], ['other@bench.example']])
+        self.assertEqual(mail.outbox[0].subject, u'Bench Portal: Membership Changed in 1 Group')
+        self.assertIn(u'New Users <b>A (a), B (b)</b> assigned to Group Bench', mail.outbox[0].body)
+        self.assertIn(u'User <b>c</b> removed from Group Bench', mail.outbox[0].body)
+        self.assertNotIn(u'D (d)', mail.outbox[0].body)
+
+    def test_debounce(self):
+        notification_queue = NotificationQueue(debounce=0.05)
+        notification_queue.add(mirror=self.notifying_mirror(), new_users=[u'A (a)'])
+        timer = notification_queue._timer
+        self.assertFalse(timer.daemon)
+        timer.join()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_debounce_error_logged(self):
+        class FailingConnection(object):
+            def send_messages(self, messages):
+                raise IOError(u"Connection refused")
+
+        handler = ListHandler()
+        logger = logging.getLogger('django_mirror_ldap_group.mirror_ldap_group')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        notification_queue = NotificationQueue(debounce=0.05, connection=FailingConnection())
+        notification_queue.add(mirror=self.notifying_mirror(), new_users=[u'A (a)'])
+        notification_queue._timer.join()
+        self.assertEqual(len(handler.records), 1)
+        self.assertIn(u"Connection refused", unicode(handler.records[0].exc_info[1]))
+
+
+class UserCacheTestCase(FakeDirectoryTestCase):
+    def test_locmem_ttl(self):
+        user_cache = LocMemUserCache(timeout=0)  # Entries expire as soon as they are set
+        user_cache.set_many({'CN=a': {'sn': ['A']}})
+        self.assertEqual(user_cache.get_many(['CN=a']), {})
+        self.assertEqual((user_cache.hits, user_cache.misses), (0, 1))
+
+    def test_locmem_lru(self):
+        user_cache = LocMemUserCache(max_entries=2)
+        user_cache.set_many({'CN=a': {'sn': ['A']}})
+        user_cache.set_many({'CN=b': {'sn': ['B']}})
+        self.assertEqual(user_cache.get_many(['CN=a']), {'CN=a': {'sn': ['A']}})  # b is now the least recently used
+        user_cache.set_many({'CN=c': {'sn': ['C']}})
+
+        self.assertEqual(sorted(user_cache.get_many(['CN=a', 'CN=b', 'CN=c'])), ['CN=a', 'CN=c'])
+        self.assertEqual((user_cache.hits, user_cache.misses), (3, 1))
+
+    def test_django_cache(self):
+        get_cache('default').clear()
+        self.addCleanup(get_cache('default').clear)
+        user_cache = DjangoUserCache()
+        user_cache.set_many({'CN=a,DC=d0,DC=bench': {'sn': ['A']}})
+
+        # Keys are case insensitive like DNs, the users come back under the DNs asked for
+        self.assertEqual(DjangoUserCache().get_many(['cn=a,dc=d0,dc=bench', 'CN=b,DC=d0,DC=bench']),
+                         {'cn=a,dc=d0,dc=bench': {'sn': ['A']}})
+        self.assertEqual(DjangoUserCache(key_prefix='other').get_many(['CN=a,DC=d0,DC=bench']), {})
+
+    def test_mirror_with_cache(self):
+        user_cache = LocMemUserCache()
+        mirror_ldap_group, status, message = self.mirror(ldap_user_cache=user_cache)
+        self.assertTrue(status, message)
+        self.assertEqual(mirror_ldap_group.report.counters['user_cache_misses'], 20)
+
+        self.directory.reset_counters()
+        mirror_ldap_group, status, message = self.mirror(ldap_user_cache=user_cache)
+        self.assertTrue(status, message)
+        self.assertEqual(mirror_ldap_group.report.counters['user_cache_hits'], 20)
+        self.assertFalse(mirror_ldap_group.report.counters.get('user_cache_misses'))
+        self.assertEqual(len(self.group_usernames()), 20)
+        self.assertEqual(self.directory.counters['searches'], 1)  # Only the group is read
+
+
+class DomainRouterTestCase(FakeDirectoryTestCase):
+    def test_declared_naming_context(self):
+        referral = dict(self.directory.servers()[1], naming_context=self.directory.naming_contexts[1])
+        domain_router = DomainRouter(discover=False)
+        with self.ldapapi(ldap_referrals=[referral], domain_router=domain_router) as ldapapi:
+            self.assertEqual(domain_router.servers_for(ldapapi, self.directory.naming_contexts[1].lower()), [referral])
+        self.assertFalse(self.directory.counters.get('searches'))  # No rootDSE was read
+
+    def test_misses(self):
+        servers = self.directory.servers()
+        domain_router = DomainRouter(discover=False)
+        with self.ldapapi(domain_router=domain_router) as ldapapi:
+            naming_context = 'DC=d9,DC=bench'
+            domain_router.failed(naming_context, servers[0], ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"}))
+            self.assertEqual(domain_router.servers_for(ldapapi, naming_context), servers)  # Down may be transient
+
+            domain_router.failed(naming_context, servers[0], ldap.REFERRAL({'desc': 'Referral'}))
+            self.assertEqual(domain_router.servers_for(ldapapi, naming_context), servers[1:])
+
+    def test_shared_router(self):
+        domain_router = DomainRouter(discover=False)
+        mirror_ldap_group, status, message = self.mirror(ldap_domain_router=domain_router)
+        self.assertTrue(status, message)
+        self.assertTrue(mirror_ldap_group.report.counters.get('ldap_referral_fallbacks'))
+
+        # The second run asks the server that answered for each domain straight away
+        mirror_ldap_group, status, message = self.mirror(ldap_domain_router=domain_router)
+        self.assertTrue(status, message)
+        self.assertFalse(mirror_ldap_group.report.counters.get('ldap_referral_fallbacks'))
+        self.assertEqual(len(self.group_usernames()), 20)
+
+    def test_shared_router_other_servers(self):
+        domain_router = DomainRouter()
+        mirror_ldap_group, status, message = self.mirror(ldap_domain_router=domain_router)
+        self.assertTrue(status, message)
+
+        # A run reaching the second domain on another domain controller is routed to its own server
+        other_referral = dict(self.directory.servers()[1],
+                              uri=self.directory.add_domain_controller(self.directory.naming_contexts[1], 'dc2'))
+        mirror_ldap_group, status, message = self.mirror(ldap_referrals=[other_referral],
+                                                         ldap_domain_router=domain_router)
+        self.assertTrue(status, message)
+        self.assertFalse(mirror_ldap_group.report.counters.get('users_removed'))
+        self.assertEqual(len(self.group_usernames()), 20)
+        with self.ldapapi(ldap_referrals=[other_referral], domain_router=domain_router) as ldapapi:
+            self.assertEqual(domain_router.servers_for(ldapapi, self.directory.naming_contexts[1]), [other_referral])
+
+
+class MirrorLDAPGroupsTestCase(FakeDirectoryTestCase):
+    def test_mirror_groups(self):
+        member_dns = self.directory.entry(self.group_dn)['member']
+        self.directory.add_group('CN=Other,OU=Groups,{0}'.format(self.directory.naming_contexts[0]),
+                                 member_dns[:10] + [self.directory.add_user(200)])
+        mirror_ldap_groups = MirrorLDAPGroups([self.ldap_group('Bench'), self.ldap_group('Other'),
+                                               self.ldap_group('Missing')], **self.ldap_options())
+        results = mirror_ldap_groups.mirror_ldap_groups()
+
+        # A group that can not be read fails on its own
+        self.assertEqual([status for status, message in results], [True, True, False])
+        self.assertIn(u"Missing Mirroring Failed!", results[2][1])
+        self.assertEqual(len(self.group_usernames('Bench')), 20)
+        self.assertEqual(self.group_usernames('Other'),
+                         set(u'user{0}'.format(index) for index in range(10) + [200]))
+        self.assertFalse(Group.objects.filter(name='Missing').exists())
+        # The 10 members of both groups are resolved once
+        self.assertEqual(mirror_ldap_groups.report.counters['shared_member_hits'], 10)
+        self.assertEqual(mirror_ldap_groups.report.counters['users_created'], 21)
+
+    def test_incremental_rejected(self):
+        self.assertRaises(ValueError, MirrorLDAPGroups, [self.ldap_group()], incremental=True, **self.ldap_options())
+        self.assertRaises(ValueError, MirrorLDAPGroups, [dict(self.ldap_group(), full_resync_interval=3600)],
+                          **self.ldap_options())
+
+
+class ReportHookTestCase(FakeDirectoryTestCase):
+    def test_query_count(self):
+        queries = connection.queries
+        queries_start = len(queries)
+        mirror_ldap_group, status, message = self.mirror()
+        self.assertTrue(status, message)
+        self.assertTrue(mirror_ldap_group.report.counters['db_queries'])
+        # With DEBUG off the SQL of the counted queries is not kept
+        self.assertIs(connection.queries, queries)
+        self.assertEqual(len(connection.queries), queries_start)
+
+    def test_logging_hook(self):
+        handler = ListHandler()
+        logger = logging.getLogger('django_mirror_ldap_group.tests')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        mirror_ldap_group, status, message = self.mirror(report_hooks=[LoggingReportHook(logger=logger,
+                                                                                         level=logging.WARNING)])
+        self.assertTrue(status, message)
+        self.assertEqual(len(handler.records), 1)
+        self.assertEqual(handler.records[0].levelno, logging.WARNING)
+        line = handler.records[0].getMessage()
+        self.assertTrue(line.startswith(u'Bench mirror succeeded phases='), line)
+        self.assertIn(u'users_created=20', line)
+
+    def test_statsd_hook(self):
+        class StubStatsClient(object):
+            def __init__(self):
+                self.timings = {}
+                self.counts = {}
+
+            def timing(self, stat, milliseconds):
+                self.timings[stat] = milliseconds
+
+            def incr(self, stat, count=1):
+                self.counts[stat] = self.counts.get(stat, 0) + count
+
+        def failing_hook(report):
+            raise RuntimeError(u"A failing hook does not fail the run")
+
+        client = StubStatsClient()
+        mirror_ldap_group, status, message = self.mirror(report_hooks=[failing_hook,
+                                                                       StatsdReportHook(client, prefix='ldap')])
+        self.assertTrue(status, message)
+        self.assertEqual(set(client.timings), set('ldap.{0}'.format(phase) for phase in mirror_ldap_group.report.phases))
+        self.assertIn('ldap.total', client.timings)
+        self.assertEqual(client.counts['ldap.users_created'], 20)
+        self.assertEqual(client.counts['ldap.runs_succeeded'], 1)
+        self.assertNotIn('ldap.runs_failed', client.counts)